@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+'''
+Compare the regular expressions P_BLOG_CONTENT and P_BLOG_EXCERPT with
+extract_marked (and with a warm ExtractCache) on the real blog: the
+source posts under blog/ and, if -o is given, the compiled posts in
+the output directory.  Checks that both give the same answers.
+Usage: bench-blog-extract.py [-o _site] [-n repeats]
+'''
+
+import os
+import glob
+import time
+import tempfile
+from optparse import OptionParser
+from util import P_BLOG_CONTENT, P_BLOG_EXCERPT, ExtractCache, extract_marked
+
+#----------------------------------------
+
+def main():
+    '''Main driver.'''
+
+    options, args = parse_args()
+    corpora = [('source', sorted(glob.glob('blog/????/??/*.html')))]
+    if options.output:
+        corpora.append(('compiled', sorted(glob.glob(os.path.join(options.output, 'blog/????/??/*.html')))))
+
+    for (name, filenames) in corpora:
+        texts = []
+        for f in filenames:
+            with open(f, 'r', encoding='utf-8') as reader:
+                texts.append(reader.read())
+        size = sum(len(t) for t in texts)
+        print('{0}: {1} files, {2} characters'.format(name, len(texts), size))
+
+        expected = check(texts, by_regex, by_find)
+        regex_time = timed(by_regex, texts, options.repeats)
+        find_time = timed(by_find, texts, options.repeats)
+        report('regex', regex_time)
+        report('find', find_time)
+        report('memo', timed_memo(filenames, options.repeats))
+        if find_time > 0:
+            print('  speedup (regex/find): {0:.1f}x'.format(regex_time / find_time))
+        print('  {0} contents, {1} excerpts found'.format(
+            sum(1 for (c, e) in expected if c is not None),
+            sum(1 for (c, e) in expected if e is not None)))
+
+#----------------------------------------
+
+def parse_args():
+    '''Parse command-line arguments.'''
+
+    parser = OptionParser()
+    parser.add_option('-o', '--output', dest='output', help='compiled site directory')
+    parser.add_option('-n', '--repeats', dest='repeats', type='int', default=5,
+                      help='number of times to repeat each measurement')
+    options, args = parser.parse_args()
+    return options, args
+
+#----------------------------------------
+
+def by_regex(text):
+    '''Extract content and excerpt the old way.'''
+    content = P_BLOG_CONTENT.search(text)
+    content = content.group(1) if content else None
+    excerpt = P_BLOG_EXCERPT.search(content if content is not None else text)
+    return content, (excerpt.group(1) if excerpt else None)
+
+
+def by_find(text):
+    '''Extract content and excerpt by scanning for the markers.'''
+    content = extract_marked(text, 'content')
+    return content, extract_marked(content if content is not None else text, 'excerpt')
+
+
+def check(texts, reference, candidate):
+    '''Make sure both methods agree, returning the reference results.'''
+    expected = [reference(t) for t in texts]
+    actual = [candidate(t) for t in texts]
+    mismatches = sum(1 for (e, a) in zip(expected, actual) if e != a)
+    assert mismatches == 0, \
+           '{0} files extracted differently'.format(mismatches)
+    return expected
+
+
+def timed(method, texts, repeats):
+    '''Best time (seconds) to apply method to all texts.'''
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        for t in texts:
+            method(t)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def timed_memo(filenames, repeats):
+    '''Best time (seconds) to get all files from a warm on-disk memo.'''
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'extract.pickle')
+        cache = ExtractCache(path)
+        for f in filenames:
+            cache.get(f)
+        cache.save()
+        best = None
+        for i in range(repeats):
+            start = time.perf_counter()
+            cache = ExtractCache(path)
+            for f in filenames:
+                cache.get(f)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(name, seconds):
+    '''Show one measurement.'''
+    print('  {0:6s} {1:8.4f}s'.format(name, seconds))
+
+#----------------------------------------
+
+if __name__ == '__main__':
+    main()
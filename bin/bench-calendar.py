@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+'''
+Time make-calendar's ICalendarWriter on a synthetic config with many
+workshops, and measure its peak memory use (beyond the config itself)
+for a tenth as many workshops and for the full number, which should be
+about the same since lines are written as they are formatted.
+Usage: bench-calendar.py [-n workshops] [-r repeats]
+'''
+
+import os
+import time
+import random
+import datetime
+import tempfile
+import importlib
+import tracemalloc
+from optparse import OptionParser
+
+# Countries, cities and names used to make up workshops.
+COUNTRIES = ['US', 'CA', 'GB', 'DE', 'AU', 'NZ', 'ZA', 'BR', 'FR', 'NO']
+CITIES = ['Toronto', 'Zürich', 'São Paulo', 'Cape Town', 'Auckland',
+          'Berkeley, CA', 'Oslo; Norway', 'Montréal', 'Melbourne', 'Leeds']
+
+#----------------------------------------
+
+def main():
+    '''Main driver.'''
+
+    options, args = parse_args()
+    writer_class = importlib.import_module('make-calendar').ICalendarWriter
+    config = make_config(options.number, options.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'workshops.ics')
+        best = None
+        for i in range(options.repeats):
+            start = time.perf_counter()
+            writer_class()(filename, config)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        size = os.path.getsize(filename)
+        print('{0} workshops: {1:.3f}s ({2:.0f} workshops/s), {3} bytes'.format(
+            options.number, best, options.number / best, size))
+
+        for n in (options.number // 10, options.number):
+            partial = dict(config, workshops=config['workshops'][:n])
+            tracemalloc.start()
+            writer_class()(filename, partial)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print('{0} workshops: peak memory {1} bytes'.format(n, peak))
+
+#----------------------------------------
+
+def parse_args():
+    '''Parse command-line arguments.'''
+
+    parser = OptionParser()
+    parser.add_option('-n', '--number', dest='number', type='int', default=50000,
+                      help='number of workshops')
+    parser.add_option('-r', '--repeats', dest='repeats', type='int', default=3,
+                      help='number of times to repeat the measurement')
+    parser.add_option('--seed', dest='seed', type='int', default=20150101,
+                      help='random number seed')
+    options, args = parser.parse_args()
+    return options, args
+
+#----------------------------------------
+
+def make_config(number, seed):
+    '''Make a config with 'number' random workshops.'''
+
+    rand = random.Random(seed)
+    first = datetime.date(2012, 1, 1)
+    workshops = []
+    for i in range(number):
+        start = first + datetime.timedelta(rand.randrange(3650))
+        city = rand.choice(CITIES)
+        workshops.append({
+            'slug' : '{0:%Y-%m-%d}-ws{1}'.format(start, i),
+            'start' : start,
+            'end' : start + datetime.timedelta(rand.choice([0, 1, 2])),
+            'venue' : 'University of {0}, Department of Long Names {1}'.format(city, i),
+            'url' : 'https://example.github.io/{0:%Y-%m-%d}-ws{1}/'.format(start, i),
+            'country' : rand.choice(COUNTRIES),
+            'latitude' : round(rand.uniform(-60, 70), 4),
+            'longitude' : round(rand.uniform(-180, 180), 4)
+        })
+    return {'site' : 'https://software-carpentry.org',
+            'timestamp' : '2015-01-01T00:00:00Z',
+            'workshops' : workshops}
+
+#----------------------------------------
+
+if __name__ == '__main__':
+    main()
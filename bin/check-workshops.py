@@ -3,8 +3,8 @@
 '''Check consistency of workshop info.'''
 
 import sys
-import yaml
 from collections import Counter
+from util import yaml_load
 
 def main():
     '''Main driver.'''
@@ -12,10 +12,10 @@ def main():
            'Usage: {0} urls_only cached_info'.format(sys.argv[0])
 
     with open(sys.argv[1]) as reader:
-        urls_only = yaml.load(reader)
+        urls_only = yaml_load(reader)
 
     with open(sys.argv[2]) as reader:
-        cached_info = [x['url'] for x in yaml.load(reader)]
+        cached_info = [x['url'] for x in yaml_load(reader)]
 
     duplicates = set(urls_only) & set(cached_info)
     if duplicates:
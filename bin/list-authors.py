@@ -6,10 +6,13 @@ Usage: authors.py $(ls blog/????/??/*.html)
 """
 
 import sys
-from util import harvest_metadata
+from util import harvest_metadata_many
 
-names = set()
-for filename in sys.argv[1:]:
-    names.add(harvest_metadata(filename)['author'])
-for n in sorted(names):
-    print(n)
+def main():
+    '''Main driver.'''
+    names = {m['author'] for m in harvest_metadata_many(sys.argv[1:])}
+    for n in sorted(names):
+        print(n)
+
+if __name__ == '__main__':
+    main()
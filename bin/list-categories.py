@@ -8,25 +8,30 @@ Usage: categories.py $(ls blog/????/??/*.html)
 import sys
 import traceback
 from collections import defaultdict
-from util import harvest_metadata
+from util import harvest_metadata_many
 
-show_count, filenames = False, sys.argv[1:]
-if filenames[0] == '-n':
-    show_count, filenames = True, filenames[1:]
+def main():
+    '''Main driver.'''
+    show_count, filenames = False, sys.argv[1:]
+    if filenames[0] == '-n':
+        show_count, filenames = True, filenames[1:]
 
-categories = defaultdict(set)
-for f in filenames:
-    try:
-        these = harvest_metadata(f)['category']
-        for t in these:
-            categories[t].add(f)
-    except Exception as e:
-        print('Failed in {0}'.format(f), file=sys.stderr)
-        traceback.print_exc(None, sys.stderr)
-        sys.exit(1)
+    categories = defaultdict(set)
+    all_meta = harvest_metadata_many(filenames)
+    for (f, meta) in zip(filenames, all_meta):
+        try:
+            for t in meta['category']:
+                categories[t].add(f)
+        except Exception as e:
+            print('Failed in {0}'.format(f), file=sys.stderr)
+            traceback.print_exc(None, sys.stderr)
+            sys.exit(1)
 
-for k in sorted(categories.keys()):
-    if show_count:
-        print('{0}: {1}'.format(len(categories[k]), k))
-    else:
-        print('{0}: {1}'.format(k, len(categories[k])))
+    for k in sorted(categories.keys()):
+        if show_count:
+            print('{0}: {1}'.format(len(categories[k]), k))
+        else:
+            print('{0}: {1}'.format(k, len(categories[k])))
+
+if __name__ == '__main__':
+    main()
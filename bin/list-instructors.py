@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 '''Get instructors per workshop from cached workshop info.'''
 import sys
-import yaml
+from util import yaml_load
 
 def main():
     '''Main driver.'''
-    workshops = yaml.load(sys.stdin)
+    workshops = yaml_load(sys.stdin)
     for b in workshops:
         for i in b['instructor']:
             print(b['slug'], i)
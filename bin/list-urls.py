@@ -3,11 +3,11 @@
 '''Get workshop URLs from _config.yml.'''
 
 import sys
-import yaml
+from util import yaml_load
 
 def main():
     '''Main driver.'''
-    config = yaml.load(sys.stdin)
+    config = yaml_load(sys.stdin)
     for w in config['workshops']:
         print(w['slug'], w['url'])
 
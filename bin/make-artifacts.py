@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+'''
+Create the calendars, the blog feeds and workshop-feed.xml in a single pass,
+loading _config.yml only once.  The individual make-*.py scripts can
+still be used to regenerate one artifact at a time.
+'''
+
+import os
+import sys
+import time
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+from util import load_info
+
+# Artifacts to generate: (name, module, function).
+ARTIFACTS = [
+    ('calendars', 'make-calendar', 'make_calendar'),
+    ('feed.xml', 'make-rss-feed', 'make_blog_feed'),
+    ('blog/*/feed.xml', 'make-rss-feed', 'make_archive_feeds'),
+    ('feeds/*/*.xml', 'make-rss-feed', 'make_topic_feeds'),
+    ('workshop-feed.xml', 'make-workshop-rss-feed', 'make_workshop_feed')
+]
+
+#----------------------------------------
+
+def main():
+    '''Main driver for artifact regeneration.'''
+
+    options, args = parse_args()
+    start = time.time()
+    config = load_info(os.curdir)
+    config['site'] = options.site
+    config['output'] = options.output
+    print('{0:20s} {1:6.2f}s'.format('(load config)', time.time() - start))
+
+    generators = [(name, getattr(importlib.import_module(module), function))
+                  for (name, module, function) in ARTIFACTS]
+    with ThreadPoolExecutor(max_workers=len(generators)) as pool:
+        futures = [(name, pool.submit(timed, generate, config, options.output))
+                   for (name, generate) in generators]
+        failed = False
+        for (name, f) in futures:
+            try:
+                print('{0:20s} {1:6.2f}s'.format(name, f.result()))
+            except Exception as e:
+                print('Failed to create {0}: {1}'.format(name, str(e)), file=sys.stderr)
+                failed = True
+
+    print('{0:20s} {1:6.2f}s'.format('(total)', time.time() - start))
+    if failed:
+        sys.exit(1)
+
+#----------------------------------------
+
+def parse_args():
+    '''Parse command-line arguments.'''
+
+    parser = OptionParser()
+    parser.add_option('-o', '--output', dest='output', help='output directory')
+    parser.add_option('-s', '--site', dest='site', help='base site URL')
+    parser.add_option('-v', '--verbose', dest='verbose', help='enable verbose logging',
+                      default=False, action='store_true')
+    options, args = parser.parse_args()
+    return options, args
+
+#----------------------------------------
+
+def timed(generate, config, output):
+    '''Run one generator and return the time it took.'''
+
+    start = time.time()
+    generate(config, output)
+    return time.time() - start
+
+#----------------------------------------
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,43 @@
 #!/usr/bin/env python3
 '''
-Compile the Software Carpentry calendar file.
+Compile the Software Carpentry calendar file, plus one calendar per
+country and one per instructor.
 '''
 
 import sys
 import os
-import yaml
 import datetime
-import re
+import hashlib
 from optparse import OptionParser
-try:  # Python 3
-    from urllib.parse import urlparse
-except ImportError:  # Python 2
-    from urlparse import urlparse
-from util import CONFIG_YML, STANDARD_YML, load_info
+from urllib.parse import urlparse
+from util import load_info, slugify
+
+# Path (relative to the output directory) of each country's or
+# instructor's calendar.
+CALENDAR_PATH = 'calendars/{0}/{1}.ics'
+
+# Number of hex digits of a name's SHA-1 used as its slug if the name
+# has no ASCII letters or digits at all.
+HASH_SLUG_LENGTH = 12
+
+# Escapes for TEXT values (RFC 5545, section 3.3.11), applied in one
+# pass.  Carriage returns are dropped so that CRLF is escaped the same
+# way as a bare newline.
+ESCAPES = str.maketrans({'\\' : '\\\\',
+                         ';' : '\\;',
+                         ',' : '\\,',
+                         '\n' : '\\n',
+                         '\r' : None})
+
+# Maximum length of a content line in octets, not counting the line
+# break (RFC 5545, section 3.1).
+MAX_LINE_OCTETS = 75
+
+# Size of the output buffer.
+BUFFER_SIZE = 1 << 16
+
+# One day (for the non-inclusive end date of events).
+ONE_DAY = datetime.timedelta(1)
 
 #----------------------------------------
 
@@ -23,10 +47,97 @@ def main():
     options, args = parse_args()
     config = load_info(os.curdir)
     config['site'] = options.site
-    calendar_file = os.path.join(options.output, 'workshops.ics')
+    changed, total = make_calendar(config, options.output)
+    if options.verbose:
+        print('calendars: {0} of {1} rewritten'.format(changed, total))
+
+#----------------------------------------
+
+def make_calendar(config, output):
+    '''
+    Write workshops.ics and the per-country and per-instructor
+    calendars into the output directory.  Files whose events haven't
+    changed are left alone (even though DTSTAMP changes every time
+    _config.yml is rebuilt), so that they keep their timestamps and the
+    web server's caching headers for them stay valid.  Per-country and
+    per-instructor calendars that weren't written this time are
+    deleted.  Returns the number of files written and the total number
+    of files.
+    '''
+
+    site = config['site']
+    timestamp = datetime.datetime.strptime(config['timestamp'], "%Y-%m-%dT%H:%M:%SZ")
+    calendars = [('workshops.ics', None, config['workshops'])]
+    for (kind, index) in sorted(index_workshops(config['workshops']).items()):
+        for slug in sorted(index.keys()):
+            name, workshops = index[slug]
+            calendars.append((CALENDAR_PATH.format(kind, slug), name, workshops))
 
     icw = ICalendarWriter()
-    icw(calendar_file, config)
+    changed = 0
+    for (path, name, workshops) in calendars:
+        if icw.save(os.path.join(output, path), site, timestamp, workshops, name):
+            changed += 1
+    remove_stale_calendars(output, {os.path.join(output, p) for (p, n, w) in calendars})
+    return changed, len(calendars)
+
+
+def remove_stale_calendars(output, written):
+    '''Delete per-country and per-instructor calendars that aren't in written.'''
+
+    for kind in ('country', 'instructor'):
+        folder = os.path.dirname(os.path.join(output, CALENDAR_PATH.format(kind, 'x')))
+        if not os.path.isdir(folder):
+            continue
+        for filename in os.listdir(folder):
+            path = os.path.join(folder, filename)
+            if filename.endswith('.ics') and (path not in written):
+                os.remove(path)
+
+#----------------------------------------
+
+def index_workshops(workshops):
+    '''
+    Build indexes from country and from instructor to workshops in a
+    single pass.  The result maps 'country' and 'instructor' to
+    dictionaries of slug => (name, [workshops in original order]).
+    Blank names are ignored.
+    '''
+
+    index = {'country' : {}, 'instructor' : {}}
+    slugs = {}
+    for bc in workshops:
+        names = {'country' : [bc['country']] if bc.get('country') else [],
+                 'instructor' : bc.get('instructor') or []}
+        for (kind, values) in names.items():
+            for name in values:
+                if name not in slugs:
+                    slugs[name] = calendar_slug(name)
+                slug = slugs[name]
+                if not slug:
+                    continue
+                if slug not in index[kind]:
+                    index[kind][slug] = (name, [])
+                index[kind][slug][1].append(bc)
+    return index
+
+
+def calendar_slug(name):
+    '''
+    Slug for a country's or instructor's calendar.  Names that have no
+    ASCII letters or digits even after transliteration (e.g., names
+    written entirely in Chinese or Arabic) get a slug made from their
+    hash instead, with a warning, so that they still get a calendar.
+    Returns '' for blank names.
+    '''
+
+    slug = slugify(name)
+    if slug or not name.strip():
+        return slug
+    slug = hashlib.sha1(name.encode('utf-8')).hexdigest()[:HASH_SLUG_LENGTH]
+    print('Calendar for "{0}" named {1} (name has no ASCII letters or digits)'.format(name, slug),
+          file=sys.stderr)
+    return slug
 
 #----------------------------------------
 
@@ -47,57 +158,122 @@ class ICalendarWriter(object):
     '''
     iCalendar generator for workshops.
     The format is defined in RFC 5545: http://tools.ietf.org/html/rfc5545
+    Lines are folded and each workshop is written straight to a
+    buffered UTF-8 stream as soon as it has been formatted, so memory use doesn't grow with the
+    number of workshops.  Anything that is the same for every workshop
+    (the UID domain and DTSTAMP) is formatted once per calendar.
     '''
 
     def __call__(self, filename, config):
-        lines = [
-            'BEGIN:VCALENDAR',
-            'VERSION:2.0',
-            'PRODID:-//Software Carpentry/Workshops//NONSGML v1.0//EN',
-        ]
-        config['timestamp'] = datetime.datetime.strptime(config['timestamp'], "%Y-%m-%dT%H:%M:%SZ")
-        for bc in config['workshops']:
-            lines.extend(self.workshop(config['site'],
-                                       config['timestamp'], bc))
-        lines.extend(['END:VCALENDAR', ''])
-        content = '\r\n'.join(lines)
+        timestamp = datetime.datetime.strptime(config['timestamp'], "%Y-%m-%dT%H:%M:%SZ")
         # From RFC 5545, section 3.1.4 (Character Set):
         # The default charset for an iCalendar stream is UTF-8.
-        with open(filename, 'wb') as writer:
-            writer.write(content.encode('utf-8'))
+        with open(filename, 'w', encoding='utf-8', newline='', buffering=BUFFER_SIZE) as writer:
+            self.write(writer, config['site'], timestamp, config['workshops'])
+
+    def save(self, filename, site, timestamp, workshops, name=None):
+        '''
+        Write a calendar to filename unless the file already holds the
+        same calendar apart from its DTSTAMP lines.  The new calendar is
+        streamed to a temporary file and compared by hash, so memory use
+        stays flat.  Returns True if filename was (re)written.
+        '''
+        os.makedirs(os.path.dirname(filename) or os.curdir, exist_ok=True)
+        temp = filename + '.tmp'
+        with open(temp, 'w', encoding='utf-8', newline='', buffering=BUFFER_SIZE) as writer:
+            self.write(writer, site, timestamp, workshops, name)
+        if os.path.isfile(filename) and (calendar_digest(filename) == calendar_digest(temp)):
+            os.remove(temp)
+            return False
+        os.replace(temp, filename)
+        return True
 
-    def workshop(self, site, timestamp, info):
-        uid = '{0}@{1}'.format(info['slug'],
-                               urlparse(site).netloc or 'software-carpentry.org')
+    def write(self, writer, site, timestamp, workshops, name=None):
+        '''Write a complete calendar of workshops to a text stream.'''
+        self.writer = writer
+        self.domain = urlparse(site).netloc or 'software-carpentry.org'
+        self.dtstamp = 'DTSTAMP:{:%Y%m%dT%H%M%SZ}'.format(timestamp)
+        self.line('BEGIN:VCALENDAR')
+        self.line('VERSION:2.0')
+        self.line('PRODID:-//Software Carpentry/Workshops//NONSGML v1.0//EN')
+        if name:
+            self.line('X-WR-CALNAME:' + self.escape('Software Carpentry workshops: ' + name))
+        for bc in workshops:
+            self.workshop(bc)
+        self.line('END:VCALENDAR')
+
+    def workshop(self, info):
+        '''Write the VEVENT for one workshop.'''
+        start = info['start']
         if ('end' in info) and info['end']:
             end = info['end']
         else:  # one day workshop?
-            end = info['start']
-        end += datetime.timedelta(1)  # non-inclusive end date
+            end = start
+        end += ONE_DAY  # non-inclusive end date
+        venue = self.escape(info['venue'])
+        url = self.escape(info['url'].strip())
+        fold = self.fold
         lines = [
-            u'BEGIN:VEVENT',
-            u'UID:{0}'.format(uid),
-            u'DTSTAMP:{:%Y%m%dT%H%M%SZ}'.format(timestamp),
-            u'DTSTART;VALUE=DATE:{:%Y%m%d}'.format(info['start']),
-            u'DTEND;VALUE=DATE:{:%Y%m%d}'.format(end),
-            u'SUMMARY:{0}'.format(self.escape(info['venue'])),
-            u'DESCRIPTION;ALTREP="{0}":{0}'.format(self.escape(info['url'].strip())),
-            u'URL:{0}'.format(self.escape(info['url'].strip())),
-            u'LOCATION:{0}'.format(self.escape(info['venue'])),
+            'BEGIN:VEVENT',
+            fold('UID:{0}@{1}'.format(info['slug'], self.domain)),
+            self.dtstamp,
+            'DTSTART;VALUE=DATE:{0:04d}{1:02d}{2:02d}'.format(start.year, start.month, start.day),
+            'DTEND;VALUE=DATE:{0:04d}{1:02d}{2:02d}'.format(end.year, end.month, end.day),
+            fold('SUMMARY:' + venue),
+            fold('DESCRIPTION;ALTREP="{0}":{0}'.format(url)),
+            fold('URL:' + url),
+            fold('LOCATION:' + venue)
         ]
         if info.get('latitude') and info.get('longitude'):
             latlng = '{0},{1}'.format(info['latitude'], info['longitude'])
-            latlng = re.sub(r'\s+', '', latlng).replace(',', ';')
-            lines.append(u'GEO:{0}'.format(latlng))
-        lines.append(u'END:VEVENT')
-        return lines
+            lines.append(fold('GEO:' + ''.join(latlng.split()).replace(',', ';')))
+        lines.append('END:VEVENT\r\n')
+        self.writer.write('\r\n'.join(lines))
+
+    def line(self, text):
+        '''Write one content line.'''
+        self.writer.write(self.fold(text) + '\r\n')
+
+    def fold(self, text):
+        '''
+        Fold a content line so that no physical line is longer than
+        MAX_LINE_OCTETS octets (continuation lines start with a space),
+        without splitting any UTF-8 character.
+        '''
+        if len(text) <= MAX_LINE_OCTETS:
+            if text.isascii() or (len(text.encode('utf-8')) <= MAX_LINE_OCTETS):
+                return text
+        if text.isascii():
+            pieces = [text[:MAX_LINE_OCTETS]]
+            pieces.extend(text[i:i+MAX_LINE_OCTETS-1]
+                          for i in range(MAX_LINE_OCTETS, len(text), MAX_LINE_OCTETS-1))
+            return '\r\n '.join(pieces)
+        data = text.encode('utf-8')
+        pieces = []
+        start, limit = 0, MAX_LINE_OCTETS
+        while len(data) - start > limit:
+            cut = start + limit
+            while (data[cut] & 0xC0) == 0x80:  # UTF-8 continuation byte
+                cut -= 1
+            pieces.append(data[start:cut].decode('utf-8'))
+            start, limit = cut, MAX_LINE_OCTETS - 1
+        pieces.append(data[start:].decode('utf-8'))
+        return '\r\n '.join(pieces)
 
     def escape(self, value):
         '''Escape text following RFC 5545.'''
-        for char in ['\\', ';', ',']:
-            value = value.replace(char, '\\' + char)
-        value.replace('\n', '\\n')
-        return value
+        return value.translate(ESCAPES)
+
+#----------------------------------------
+
+def calendar_digest(filename):
+    '''Hash a calendar file, ignoring its DTSTAMP lines.'''
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as reader:
+        for line in reader:
+            if not line.startswith(b'DTSTAMP:'):
+                digest.update(line)
+    return digest.hexdigest()
 
 #----------------------------------------
 
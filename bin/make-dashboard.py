@@ -1,10 +1,26 @@
 #!/usr/bin/env python3
 
-'''Create YAML for dashboard page by querying GitHub repositories.'''
+'''
+Create YAML for dashboard page by querying GitHub repositories.
+Usage: make-dashboard.py [-a api_url] [-j jobs] [-t ttl] token_file output_file
+-a: GitHub API base URL (default https://api.github.com)
+-j: number of repositories to query at once (default 8)
+-t: only refresh repositories last updated more than this many
+    seconds ago (default 3600)
+Open issues are cached per repository in _dashboard_state.pickle, and
+later runs only ask for issues updated since the newest one seen, using
+conditional requests so that unchanged repositories cost nothing.  If
+GitHub can't be reached, the last-known data is used and marked stale.
+The output file is only rewritten if its content changes.
+'''
 
 import sys
-import yaml
-from util import DASHBOARD_CACHE
+import time
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+import requests
+from util import DASHBOARD_STATE, yaml_dump, load_pickle, save_pickle, \
+                 write_if_changed
 
 CONTROLS = (
     ('swcarpentry/shell-novice', 'Unix Shell'),
@@ -23,57 +39,173 @@ CONTROLS = (
     ('swcarpentry/site', 'Software Carpentry website'),
 )
 
-def get_connection(token_file):
-    '''Get a connection to GitHub if the library and token file are available.'''
+GITHUB_API = 'https://api.github.com'
+
+DEFAULT_JOBS = 8
+
+# Refresh repositories whose data is older than this (in seconds).
+DEFAULT_TTL = 60 * 60
+
+# Version of the per-repository state file's layout.
+STATE_VERSION = 1
+
+# Give up on a GitHub request after this many seconds.
+GITHUB_TIMEOUT = 30
+
+class GitHub(object):
+    '''Minimal GitHub REST client with conditional requests and pagination.'''
+
+    def __init__(self, token, api_url=GITHUB_API, jobs=DEFAULT_JOBS):
+        self.api_url = api_url.rstrip('/')
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Accept'] = 'application/vnd.github.v3+json'
+        if token:
+            self.session.headers['Authorization'] = 'token {0}'.format(token)
+
+    def get(self, path, params=None, etag=None):
+        '''
+        Get a resource, returning (data, etag), or (None, etag) if etag
+        was given and the resource hasn't changed.  Follows pagination
+        links and concatenates pages if the result is a list.
+        '''
+        headers = {'If-None-Match' : etag} if etag else {}
+        response = self.session.get(self.api_url + path, params=params, headers=headers,
+                                    timeout=GITHUB_TIMEOUT)
+        if response.status_code == 304:
+            return None, etag
+        response.raise_for_status()
+        new_etag = response.headers.get('ETag')
+        data = response.json()
+        while isinstance(data, list) and ('next' in response.links):
+            response = self.session.get(response.links['next']['url'], timeout=GITHUB_TIMEOUT)
+            response.raise_for_status()
+            data.extend(response.json())
+        return data, new_etag
+
+def get_connection(token_file, api_url=GITHUB_API, jobs=DEFAULT_JOBS):
+    '''Get a connection to GitHub if the token file is available.'''
     try:
-        from github import Github
         with open(token_file, 'r') as reader:
             token = reader.read().strip()
-        cnx = Github(token)
+        cnx = GitHub(token, api_url, jobs)
     except:
-        print('Unable to connect using {0} (or missing github library)'.format(token_file), file=sys.stderr)
+        print('Unable to connect using {0}'.format(token_file), file=sys.stderr)
         cnx = None
     return cnx
 
-def process(cnx):
-    '''Gather information.'''
-    if not cnx:
-        return []
+def collect(cnx, ident, state):
+    '''
+    Bring the cached state for one repository up to date: re-check its
+    metadata, then either fetch all open issues (first time) or only
+    issues updated since the newest one seen before.
+    '''
+    state = dict(state or {})
+    print('+', ident)
+    repo, state['repo_etag'] = cnx.get('/repos/{0}'.format(ident), etag=state.get('repo_etag'))
+    if repo is not None:
+        state['url'] = str(repo['html_url'])
+
+    if state.get('since') is None:
+        found, state['issues_etag'] = cnx.get('/repos/{0}/issues'.format(ident),
+                                              params={'state' : 'open', 'per_page' : 100},
+                                              etag=state.get('issues_etag'))
+        issues = {} if (found is not None) else dict(state.get('issues', {}))
+    else:
+        found, state['issues_etag'] = cnx.get('/repos/{0}/issues'.format(ident),
+                                              params={'state' : 'all', 'per_page' : 100,
+                                                      'since' : state['since']},
+                                              etag=state.get('issues_etag'))
+        issues = dict(state['issues'])
+
+    for i in (found or []):
+        state['since'] = max(state.get('since') or '', i['updated_at'])
+        if i['state'] == 'open':
+            issues[i['number']] = {'number' : i['number'],
+                                   'title' : str(i['title']),
+                                   'url' : str(i['html_url']),
+                                   'updated' : i['updated_at'][:10]}
+        else:
+            issues.pop(i['number'], None)
+    state['issues'] = issues
+    state.setdefault('since', None)
+    state['fetched'] = time.time()
+    return state
+
+def process(cnx, states, jobs=DEFAULT_JOBS, ttl=DEFAULT_TTL):
+    '''
+    Gather information, updating per-repository states in place.  Only
+    repositories whose state is older than ttl seconds are queried; if
+    that fails (or there's no connection), the last-known state is used
+    and the record is marked stale.
+    '''
     all_records = []
     dashboard = {
         'records' : all_records,
         'num_repos' : 0,
-        'num_issues' : 0
+        'num_issues' : 0,
+        'num_stale' : 0
     }
+
+    def update(ident):
+        try:
+            return collect(cnx, ident, states.get(ident))
+        except (requests.Timeout, requests.ConnectionError) as e:
+            print('unable to reach GitHub for {0}: {1}'.format(ident, str(e)), file=sys.stderr)
+            return None
+        except Exception as e:
+            print('failed to update {0}: {1}'.format(ident, str(e)), file=sys.stderr)
+            return None
+
+    now = time.time()
+    stale = [ident for (ident, description) in CONTROLS
+             if (ident not in states) or (now - states[ident]['fetched'] > ttl)]
+    if cnx and stale:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            for (ident, state) in zip(stale, pool.map(update, stale)):
+                if state is not None:
+                    states[ident] = state
+    elif stale:
+        print('No connection: using last-known data for {0} repositories'.format(len(stale)), file=sys.stderr)
+
     for (ident, description) in CONTROLS:
-        print('+', ident)
+        state = states.get(ident)
+        if state is None:
+            continue
         dashboard['num_repos'] += 1
-        r = cnx.get_repo(ident)
         record = {'ident' : ident,
                   'description' : description,
-                  'url' : str(r.html_url),
-                  'issues' : []}
+                  'url' : state.get('url', 'https://github.com/{0}'.format(ident)),
+                  'stale' : (now - state['fetched']) > ttl,
+                  'issues' : sorted(state['issues'].values(), key=lambda x: x['updated'])}
         all_records.append(record)
-        for i in r.get_issues(state='open'):
-            try:
-                record['issues'].append({'number' : i.number,
-                                         'title' : str(i.title),
-                                         'url' : str(i.html_url),
-                                         'updated' : i.updated_at.strftime('%Y-%m-%d')})
-            except Exception as e:
-                print('failed with', i.number, i.title, i.html_url, i.updated_at, file=sys.stderr)
-            dashboard['num_issues'] += 1
-        record['issues'].sort(key=lambda x: x['updated'])
+        dashboard['num_issues'] += len(record['issues'])
+        dashboard['num_stale'] += record['stale']
     return dashboard
 
+def parse_args():
+    '''Parse command-line arguments.'''
+    parser = OptionParser()
+    parser.add_option('-a', '--api-url', dest='api_url', default=GITHUB_API,
+                      help='GitHub API base URL')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=DEFAULT_JOBS,
+                      help='number of repositories to query at once')
+    parser.add_option('-t', '--ttl', dest='ttl', type='float', default=DEFAULT_TTL,
+                      help='refresh repositories whose data is older than this (seconds)')
+    return parser.parse_args()
+
 def main():
     '''Main driver.'''
-    token_file = sys.argv[1]
-    output_file = sys.argv[2]
-    cnx = get_connection(token_file)
-    dashboard = process(cnx)
-    with open(output_file, 'w') as writer:
-        yaml.dump(dashboard, writer, encoding='utf-8', allow_unicode=True)
+    options, args = parse_args()
+    token_file, output_file = args
+    cnx = get_connection(token_file, options.api_url, options.jobs)
+    saved = load_pickle(DASHBOARD_STATE, STATE_VERSION)
+    states = saved['repos'] if saved else {}
+    dashboard = process(cnx, states, options.jobs, options.ttl)
+    save_pickle(DASHBOARD_STATE, {'version' : STATE_VERSION, 'repos' : states})
+    write_if_changed(output_file, yaml_dump(dashboard))
 
 if __name__ == '__main__':
     main()
@@ -1,13 +1,41 @@
 #!/usr/bin/env python3
 '''
-Create feed.xml for Software Carpentry blog.
+Create feed.xml (RSS 2.0) and atom.xml (Atom) for Software Carpentry
+blog, plus one RFC 5005 archive page per year (blog/YYYY/feed.xml) so
+that the whole blog is available as a paged feed, and one feed of
+recent posts for each category and author (feeds/category/NAME.xml and
+feeds/author/NAME.xml).
 '''
 
 import os
+import atexit
+import io
+import re
 import datetime
+import hashlib
+import threading
 from optparse import OptionParser
-from util import CONFIG_YML, STANDARD_YML, P_BLOG_CONTENT, P_BLOG_EXCERPT, \
-                 load_info, ContentEncodedRSS2, ContentEncodedRSSItem
+from util import EXTRACT_CACHE, ARCHIVE_STATE, ExtractCache, load_info, write_if_changed, \
+                 slugify, load_pickle, save_pickle, FeedWriter, write_feed
+
+# Path (relative to the site root) of each year's archive page.
+ARCHIVE_FEED = 'blog/{0}/feed.xml'
+
+# Version of the layout of ARCHIVE_STATE (and of the archive pages:
+# change this if their rendering changes so that all are rebuilt).
+ARCHIVE_STATE_VERSION = 1
+
+# Path (relative to the site root) of each category's or author's feed.
+TOPIC_FEED = 'feeds/{0}/{1}.xml'
+
+# Separators between names in a post's 'author' field
+# ("A, B, and C" or "A and B").
+P_AUTHOR_SEP = re.compile(r'\s*,\s*(?:and\s+)?|\s+and\s+')
+
+# Memo of compiled posts' content and excerpts, shared by all the feeds
+# built in this process (created when first needed, saved at exit).
+_extract_cache = None
+_extract_cache_lock = threading.Lock()
 
 #----------------------------------------
 
@@ -18,13 +46,181 @@ def main():
     config = load_info(os.curdir)
     config['site'] = options.site
     config['output'] = options.output
+    make_blog_feed(config, options.output)
+    changed, total = make_archive_feeds(config, options.output)
+    if options.verbose:
+        print('archive feeds: {0} of {1} pages rewritten'.format(changed, total))
+    changed, total = make_topic_feeds(config, options.output)
+    if options.verbose:
+        print('category and author feeds: {0} of {1} rewritten'.format(changed, total))
+
+#----------------------------------------
+
+def make_blog_feed(config, output):
+    '''Write feed.xml and atom.xml for recent blog posts into the output directory.'''
 
     selection = config['blog'][-config['recent_length']:]
     selection.reverse()
+    links = [('current', os.path.join(config['site'], 'feed.xml'))]
+    pages = plan_archive_pages(config)
+    if pages:
+        links.append(('prev-archive', os.path.join(config['site'], pages[-1]['path'])))
     build_blog_rss(config,
-                   os.path.join(options.output, 'feed.xml'),
-                   selection)
-    
+                   os.path.join(output, 'feed.xml'),
+                   selection,
+                   atom_filename=os.path.join(output, 'atom.xml'),
+                   links=links)
+
+#----------------------------------------
+
+def make_archive_feeds(config, output):
+    '''
+    Write one archive feed per year of blog posts into the output
+    directory, each linked to its neighbours and to the current feed.
+    Only years before the build date are marked as (complete) archive
+    pages.  A page is only rendered if its inputs (see
+    archive_signature) differ from those it was last built from, so a
+    rebuild normally reads only the current year's posts.  Returns the
+    number of pages written and the number of pages.
+    '''
+
+    site = config['site']
+    this_year = config.get('today', datetime.date.today()).year
+    saved = load_pickle(ARCHIVE_STATE, ARCHIVE_STATE_VERSION)
+    signatures = saved['pages'] if saved else {}
+    pages = plan_archive_pages(config)
+    changed = 0
+    for (i, page) in enumerate(pages):
+        links = [('self', os.path.join(site, page['path'])),
+                 ('current', os.path.join(site, 'feed.xml'))]
+        if i > 0:
+            links.append(('prev-archive', os.path.join(site, pages[i-1]['path'])))
+        if i < len(pages) - 1:
+            links.append(('next-archive', os.path.join(site, pages[i+1]['path'])))
+        archive = int(page['year']) < this_year
+        path = os.path.join(output, page['path'])
+        key = os.path.abspath(path)
+        signature = archive_signature(config, page, links, archive)
+        if (signatures.get(key) == signature) and os.path.isfile(path):
+            continue
+        text = io.StringIO()
+        write_blog_feed(config, text, 'rss', page['posts'],
+                        updated=page['updated'],
+                        links=links,
+                        archive=archive)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if write_if_changed(path, text.getvalue()):
+            changed += 1
+        signatures[key] = signature
+    signatures = {k : v for (k, v) in signatures.items() if os.path.isfile(k)}
+    save_pickle(ARCHIVE_STATE, {'version' : ARCHIVE_STATE_VERSION,
+                                'pages' : signatures})
+    return changed, len(pages)
+
+
+def archive_signature(config, page, links, archive):
+    '''
+    Digest of everything an archive page is built from: the blog's
+    title, the page's links and status, each post's metadata, and the
+    size and modification time of each post's source file and layout.
+    '''
+
+    def source(path):
+        try:
+            st = os.stat(path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    layouts = sorted({p.get('layout') or '' for p in page['posts']})
+    inputs = (config['blog_title'], config['blog_subtitle'], links, archive, page['updated'],
+              [(name, source(os.path.join('_layouts', name + '.html'))) for name in layouts],
+              [(p['path'], p['title'], p['author'], p['date'], p.get('time'), source(p['path']))
+               for p in page['posts']])
+    return hashlib.sha1(repr(inputs).encode('utf-8')).hexdigest()
+
+#----------------------------------------
+
+def plan_archive_pages(config):
+    '''
+    Plan the archive feed: one page per year in config['blog_lookup'],
+    oldest first.  Each page records its year, its path relative to
+    the site root, its posts (newest first), and the date of its
+    newest post, which is used as the page's build date so that an
+    unchanged page renders identically every time.
+    '''
+
+    lookup = config['blog_lookup']
+    pages = []
+    for year in sorted(lookup.keys()):
+        posts = [p for month in sorted(lookup[year].keys()) for p in lookup[year][month]]
+        if not posts:
+            continue
+        posts.reverse()
+        pages.append({'year' : year,
+                      'path' : ARCHIVE_FEED.format(year),
+                      'posts' : posts,
+                      'updated' : max(p['date'] for p in posts)})
+    return pages
+
+#----------------------------------------
+
+def make_topic_feeds(config, output):
+    '''
+    Write a feed of recent posts for each category and each author
+    into the output directory.  The indexes are built in one pass over
+    the blog, and compiled posts are memoized (see get_extract_cache)
+    so that a post appearing in several feeds is only read once.  As with the archive pages,
+    each feed's build date is its newest post's date and unchanged
+    feeds are not rewritten.  Returns the number of feeds written and
+    the number of feeds.
+    '''
+
+    site = config['site']
+    changed = total = 0
+    for (kind, index) in sorted(index_blog_topics(config['blog']).items()):
+        for slug in sorted(index.keys()):
+            name, posts = index[slug]
+            posts = posts[-config['recent_length']:]
+            posts.reverse()
+            path = TOPIC_FEED.format(kind, slug)
+            text = io.StringIO()
+            write_blog_feed(config, text, 'rss', posts,
+                            title='{0}: {1}'.format(config['blog_title'], name),
+                            updated=max(p['date'] for p in posts),
+                            links=[('self', os.path.join(site, path))])
+            path = os.path.join(output, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if write_if_changed(path, text.getvalue()):
+                changed += 1
+            total += 1
+    return changed, total
+
+#----------------------------------------
+
+def index_blog_topics(posts):
+    '''
+    Build inverted indexes from category and from author to posts in a
+    single pass.  The result maps 'category' and 'author' to
+    dictionaries of slug => (name, [posts in blog order]).  Posts with
+    several authors appear under each of them.
+    '''
+
+    index = {'category' : {}, 'author' : {}}
+    for p in posts:
+        names = {'category' : p.get('category') or [],
+                 'author' : P_AUTHOR_SEP.split(p['author'].strip())}
+        for (kind, values) in names.items():
+            for name in values:
+                slug = slugify(name)
+                if not slug:
+                    continue
+                if slug not in index[kind]:
+                    index[kind][slug] = (name, [])
+                index[kind][slug][1].append(p)
+    return index
+
+
 #----------------------------------------
 
 def parse_args():
@@ -40,37 +236,49 @@ def parse_args():
 
 #----------------------------------------
 
-def build_blog_rss(config, filename, all_posts):
+def build_blog_rss(config, filename, all_posts, atom_filename=None, links=None):
     '''
-    Generate RSS2 feed.xml file for blog given the metadata blobs for
-    recent posts.
+    Generate RSS2 feed.xml file (and optionally an Atom equivalent) for
+    blog given the metadata blobs for recent posts.
     '''
 
-    # Fill in rendered content and excerpt.
-    for p in all_posts:
-        p['content'], p['excerpt'] = get_blog_content_excerpt(config, p['path'])
+    with open(filename, 'w', encoding='utf-8') as rss_stream:
+        if atom_filename is None:
+            write_blog_feed(config, rss_stream, 'rss', all_posts, links=links)
+        else:
+            with open(atom_filename, 'w', encoding='utf-8') as atom_stream:
+                write_blog_feed(config, [rss_stream, atom_stream], ['rss', 'atom'],
+                                all_posts, links=links)
+
+#----------------------------------------
+
+def write_blog_feed(config, streams, formats, posts, **kwargs):
+    '''
+    Write a feed of posts to one or more streams (one per format).
+    Posts are read one at a time as they are written.  Extra keyword
+    arguments are passed on to FeedWriter.
+    '''
 
-    # Create RSS items.
+    if isinstance(formats, str):
+        streams, formats = [streams], [formats]
     site = config['site']
-    items = [ContentEncodedRSSItem(title=p['title'],
-                                   creator=p['author'],
-                                   link=os.path.join(site, p['path']),
-                                   description=p['excerpt'],
-                                   content=p['content'],
-                                   pubDate=datetime.datetime.fromordinal(
-                                     p['date'].toordinal()))
-             for p in all_posts]
-
-    # Create RSS feed.
-    rss = ContentEncodedRSS2(title=config['blog_title'],
-                             description=config['blog_subtitle'],
-                             lastBuildDate=datetime.datetime.utcnow(),
-                             link=site,
-                             items=items)
-
-    # Save.
-    with open(filename, 'w') as writer:
-        rss.write_xml(writer)
+    channel = {'title' : config['blog_title'],
+               'link' : site,
+               'description' : config['blog_subtitle']}
+    channel.update(kwargs)
+
+    def items():
+        for p in posts:
+            content, excerpt = get_blog_content_excerpt(config, p['path'])
+            yield {'title' : p['title'],
+                   'creator' : p['author'],
+                   'link' : os.path.join(site, p['path']),
+                   'description' : excerpt,
+                   'content' : content,
+                   'date' : p['date']}
+
+    write_feed(items(), *[FeedWriter(stream, fmt, **channel)
+                          for (stream, fmt) in zip(streams, formats)])
 
 #----------------------------------------
 
@@ -87,21 +295,23 @@ def get_blog_content_excerpt(config, filename):
     always be present.  The 'excerpt' markers have only been added
     starting in May 2013; earlier blog posts no longer have excerpts
     included in feed.xml, so this function may return None for them.
+    Results are memoized on disk (see util.ExtractCache).
     '''
     path = os.path.join(config['output'], filename)
-    with open(path, 'r') as reader:
-        temp = reader.read()
-        temp = P_BLOG_CONTENT.search(temp)
-        assert temp, \
-               'Blog entry "{0}" lacks content markers'.format(path)
-        content = temp.group(1)
-
-        temp = P_BLOG_EXCERPT.search(content)
-        excerpt = None
-        if temp:
-            excerpt = temp.group(1)
-
-        return content, excerpt
+    content, excerpt = get_extract_cache().get(path)
+    assert content is not None, \
+           'Blog entry "{0}" lacks content markers'.format(path)
+    return content, excerpt
+
+
+def get_extract_cache():
+    '''Return the memo of compiled posts shared by all feeds.'''
+    global _extract_cache
+    with _extract_cache_lock:
+        if _extract_cache is None:
+            _extract_cache = ExtractCache(EXTRACT_CACHE)
+            atexit.register(_extract_cache.save)
+        return _extract_cache
 
 #----------------------------------------
 
@@ -8,10 +8,7 @@ import datetime
 import os
 import sys
 from optparse import OptionParser
-from PyRSS2Gen import Category, Guid
-from util import ContentEncodedRSS2, ContentEncodedRSSItem
-from urllib.parse import urlparse
-from util import load_info
+from util import load_info, as_date, WorkshopIndex, FeedWriter, write_feed
 
 #----------------------------------------
 
@@ -21,10 +18,17 @@ def main():
     options, args = parse_args()
     config = load_info(os.curdir)
     config['site'] = options.site
+    make_workshop_feed(config, options.output)
 
-    workshops = get_future_workshops(config['workshops'])
+#----------------------------------------
+
+def make_workshop_feed(config, output):
+    '''Write workshop-feed.xml for upcoming workshops into the output directory.'''
+
+    workshops = get_future_workshops(config['workshops'],
+                                     as_date(config.get('today') or datetime.date.today()))
     build_workshop_rss(config,
-                       os.path.join(options.output, 'workshop-feed.xml'),
+                       os.path.join(output, 'workshop-feed.xml'),
                        workshops)
 
 #----------------------------------------
@@ -48,58 +52,52 @@ def build_workshop_rss(config, filename, workshops):
     recent workshops.
     '''
     site = config['site']
-    publish_time = datetime.datetime.now()
-    # Create RSS items.
-    try:
-        items = [ContentEncodedRSSItem(title=bc['venue'],
-                                       creator=bc['contact'],
-                                       guid=get_guid(site, bc),
-                                       link=bc['url'],
-                                       description=get_description(bc),
-                                       categories=[get_country(site, bc)],
-                                       pubDate=publish_time)
-                 for bc in workshops]
-    except KeyError as e:
-        print('Failed to find key {0} in {1}'.format(str(e), bc), file=sys.stderr)
-        sys.exit(1)
-
-    # Create RSS feed.
-    rss = ContentEncodedRSS2(title='Software Carpentry workshops',
-                             description='Helping researchers do more, in less time, with less pain',
-                             lastBuildDate=datetime.datetime.utcnow(),
-                             link=site,
-                             items=items)
-
-    # Save.
-    with open(filename, 'w') as writer:
-        rss.write_xml(writer)
-
-def get_future_workshops(workshops):
+    publish_time = datetime.datetime.utcnow()
+
+    def items():
+        for bc in workshops:
+            try:
+                yield {'title' : bc['venue'],
+                       'creator' : bc['contact'],
+                       'guid' : get_guid(site, bc),
+                       'permalink' : False,
+                       'link' : bc['url'],
+                       'description' : get_description(bc),
+                       'categories' : [get_country(site, bc)],
+                       'date' : publish_time}
+            except KeyError as e:
+                print('Failed to find key {0} in {1}'.format(str(e), bc), file=sys.stderr)
+                sys.exit(1)
+
+    with open(filename, 'w', encoding='utf-8') as writer:
+        write_feed(items(),
+                   FeedWriter(writer, 'rss',
+                              title='Software Carpentry workshops',
+                              link=site,
+                              description='Helping researchers do more, in less time, with less pain',
+                              updated=publish_time))
+
+def get_future_workshops(workshops, today):
     '''
-    Create a list of workshops that are in the future and return these
-    in reverse chronological order.
+    Create a list of workshops starting on or after today (the build
+    date used by preprocess.py) and return these soonest first.
     '''
-    publish_date = datetime.datetime.now().date()
-    workshops = [bc for bc in workshops if bc['start'] >= publish_date]
-    workshops.reverse()
-    return workshops
+    return WorkshopIndex(workshops).upcoming(today)
 
 def get_guid(site, workshop):
     '''
-    Create non-permalink Guid consisting of Software Carpentry
+    Create non-permalink guid consisting of Software Carpentry
     site URL and workshop identifier ('slug').
     '''
-    return Guid('{0}/{1}'.format(site, workshop['slug']),
-                isPermaLink=False)
+    return '{0}/{1}'.format(site, workshop['slug'])
 
 def get_country(site, workshop):
     '''
     Create 'country' category in domain
     http://software-carpentry.org/locations with workshop's country
-    as value.
+    as value, as a (term, domain) pair.
     '''
-    return Category(workshop['country'],
-                    '{0}/{1}'.format(site, 'locations'))
+    return (workshop['country'], '{0}/{1}'.format(site, 'locations'))
 
 def get_description(workshop):
     '''
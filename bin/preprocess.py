@@ -5,24 +5,26 @@ Create _config.yml used to compile Software Carpentry web site.
 
 import sys
 import os
+import copy
 import glob
 import datetime
 import time
-import yaml
-from functools import cmp_to_key
+import json
 from optparse import OptionParser
-from urllib.parse import urlparse, urljoin
 from util import CONFIG_YML, \
+                 CONFIG_SIDECAR, \
                  STANDARD_YML, \
-                 AIRPORTS_YML, \
-                 BADGES_YML, \
                  BADGES_URL, AIRPORTS_URL, WORKSHOPS_URL, \
-                 WORKSHOPS_YML, \
-                 WORKSHOP_CACHE, \
                  DASHBOARD_CACHE, \
-                 P_BLOG_EXCERPT, \
-                 harvest_metadata, \
-                 load_info, fetch_info
+                 REPO_TRENDS, \
+                 HARVEST_CACHE, \
+                 AMY_CACHE, \
+                 EXTRACT_CACHE, \
+                 HarvestCache, FetchCache, ExtractCache, \
+                 harvest_metadata_many, file_digest, \
+                 load_info, save_sidecar, fetch_info_many, OfflineError, yaml_dump, \
+                 extract_blog_parts, as_date, WorkshopIndex, GeoIndex, get_coords, \
+                 MAP_DIR, MAP_MAX_ZOOM, cluster_points, write_if_changed
 
 # Translate two-digit month identifiers into short names.
 MONTHS = {
@@ -31,6 +33,14 @@ MONTHS = {
     '09' : 'Sep', '10' : 'Oct', '11' : 'Nov', '12' : 'Dec'
 }
 
+# Dashboard used if there's no cached dashboard information.
+EMPTY_DASHBOARD = {
+    'records' : [],
+    'num_repos' : 0,
+    'num_issues' : 0,
+    'num_stale' : 0
+}
+
 # Template for recent blog posts.
 RECENT_POST = '''\
 <h4><a href="{{page.root}}/%(path)s">%(title)s</a></h4>
@@ -61,17 +71,30 @@ def main():
         'months'          : sorted(MONTHS.keys()),
         'site'            : options.site,
         'timestamp'       : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
-        'today'           : options.today
+        'today'           : as_date(options.today)
     })
 
-    # Load cached dashboard info.  Do this early to avoid wasting time
-    # on everything else if it's not available.
-    config['dashboard'] = load_cached_info(os.curdir, DASHBOARD_CACHE, 'dashboard cache')
-
-    # Fetch information from AMY.
-    config['badges'] = fetch_info(options.amy_url, BADGES_URL)
-    config['airports'] = fetch_info(options.amy_url, AIRPORTS_URL)
-    config['workshops'] = fetch_info(options.amy_url, WORKSHOPS_URL)
+    # Load cached dashboard info (or build without it if it's missing).
+    config['dashboard'] = load_cached_info(os.curdir, DASHBOARD_CACHE, 'dashboard cache',
+                                           EMPTY_DASHBOARD)
+
+    # Load repository activity trends if repo-stats.py has produced them.
+    if os.path.isfile(REPO_TRENDS):
+        config['repo_trends'] = load_info(os.curdir, REPO_TRENDS)
+
+    # Fetch information from AMY (concurrently, and re-using cached
+    # exports if they haven't changed or we're working offline).
+    amy_cache = None if options.no_cache else FetchCache(AMY_CACHE)
+    try:
+        config['badges'], config['airports'], config['workshops'] = \
+            fetch_info_many(options.amy_url, [BADGES_URL, AIRPORTS_URL, WORKSHOPS_URL],
+                            amy_cache, options.max_age, options.offline)
+    except OfflineError as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
+    if amy_cache is not None:
+        amy_cache.save()
+        print(amy_cache.report())
 
     # Lower-case and coalesce national flags.
     for a in config['airports']:
@@ -84,19 +107,37 @@ def main():
     }
 
     # Select workshops that will be displayed on the home page (soonest first).
-    workshops_upcoming = [w for w in config['workshops'] if w['start'] >= config['today']]
-    workshops_upcoming.reverse()
+    workshops_upcoming = WorkshopIndex(config['workshops']).upcoming(config['today'])
     config['workshops_upcoming'] = workshops_upcoming
     config['workshops_upcoming_short'] = workshops_upcoming[ :config['upcoming_length'] ]
 
+    # Find instructors near each upcoming workshop (keyed by workshop slug).
+    config['workshops_nearby'] = find_nearby_instructors(workshops_upcoming,
+                                                         config['airports'],
+                                                         config['nearby_radius'],
+                                                         config['nearby_length'])
+
+    # Write pre-clustered markers for the workshop and instructor maps.
+    config['map_max_zoom'] = MAP_MAX_ZOOM
+    changed, total = write_map_data(config['workshops'], config['airports'], config['today'])
+    print('map data: {0} of {1} files rewritten'.format(changed, total))
+
     # Load people and projects.
     config['people'] = list(map(lambda x: os.path.relpath(x, '_includes'),
                                 sorted(glob.glob('_includes/people/*.html'))))
     config['projects'] = list(map(lambda x: os.path.relpath(x, '_includes'),
                                   sorted(glob.glob('_includes/projects/*.html'))))
 
-    # Get information from blog entries.
-    config['blog'] = harvest_blog(config)
+    # Get information from blog entries, re-using cached metadata for
+    # unchanged posts unless told not to.
+    cache = None
+    if not options.no_cache:
+        cache = HarvestCache(HARVEST_CACHE,
+                             file_digest(os.path.join(options.config_dir, STANDARD_YML)))
+    config['blog'] = harvest_blog(config, cache, options.jobs)
+    if cache is not None:
+        cache.save()
+        print(cache.report())
 
     # Sanity checks on blog posts.
     check_blog_sanity(config['blog'])
@@ -107,8 +148,11 @@ def main():
 
     # Create _includes/recent_blog_posts.html for inclusion in blog index page.
     # This is done programmatically because we want snippets to be rendered properly.
+    extract_cache = None if options.no_cache else ExtractCache(EXTRACT_CACHE)
     for post in config['blog_recent']:
-        post['excerpt'] = get_blog_excerpt(post['path'])
+        post['excerpt'] = get_blog_excerpt(post['path'], extract_cache)
+    if extract_cache is not None:
+        extract_cache.save()
     write_recent_blog_posts(config['blog_recent'])
 
     # Organize all posts by year and month.
@@ -122,9 +166,10 @@ def main():
     config['blog_favorites'] = [p for p in config['blog'] if p['favorite']]
     config['blog_favorites'].reverse()
 
-    # Save.
-    with open(CONFIG_YML, 'w') as writer:
-        yaml.dump(config, writer, encoding='utf-8', allow_unicode=True)
+    # Save, along with a fast-loading copy for the feed and calendar generators.
+    with open(CONFIG_YML, 'w', encoding='utf-8') as writer:
+        yaml_dump(config, writer)
+    save_sidecar(CONFIG_SIDECAR, CONFIG_YML, config)
 
 #----------------------------------------
 
@@ -135,43 +180,155 @@ def parse_args():
     parser.add_option('-c', '--config', dest='config_dir', help='configuration directory')
     parser.add_option('-o', '--output', dest='output', help='output directory')
     parser.add_option('-s', '--site', dest='site', help='site')
-    parser.add_option('-t', '--today', dest='today', help='build date',
+    parser.add_option('-t', '--today', dest='today', help='build date (YYYY-MM-DD)',
                       default=datetime.date.today())
     parser.add_option('-a', '--amy-url', dest='amy_url',
                       default='https://amy.software-carpentry.org/api/',
                       help='AMY API address')
     parser.add_option('-v', '--verbose', dest='verbose', help='enable verbose logging',
                       default=False, action='store_true')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                      help='number of processes used to harvest blog metadata')
+    parser.add_option('--no-cache', dest='no_cache',
+                      help='do not use cached blog metadata, excerpts or AMY exports',
+                      default=False, action='store_true')
+    parser.add_option('--max-age', dest='max_age', type='float', default=None,
+                      help='use cached AMY exports younger than this many seconds without revalidating')
+    parser.add_option('--offline', dest='offline', help='use cached AMY exports only',
+                      default=False, action='store_true')
     options, args = parser.parse_args()
     return options, args
 
 #----------------------------------------
 
-def load_cached_info(folder, filename, message):
-    '''Load cached info if available, fail if not.'''
+def load_cached_info(folder, filename, message, default=None):
+    '''
+    Load cached info if available.  If not, warn and return a copy of
+    default, or fail if there is no default.
+    '''
     path = os.path.join(folder, filename)
     if not os.path.isfile(path):
         print('{0} file "{1}" does not exist.'.format(message, path), file=sys.stderr)
+        if default is not None:
+            print('Building without it: use "make cache" to create it.', file=sys.stderr)
+            return copy.deepcopy(default)
         print('Please use "make cache" before building site,', file=sys.stderr)
         sys.exit(1)
     return load_info(folder, filename)
 
 #----------------------------------------
 
-def harvest_blog(config):
-    '''Harvest metadata for all blog entries.
+def find_nearby_instructors(workshops, airports, radius, length):
+    '''
+    For each workshop with a location, list up to 'length' instructors
+    based at airports within 'radius' km, nearest first, as a
+    dictionary keyed by workshop slug.  Each entry has the instructor's
+    name and user ID, the airport's IATA code, and the distance in km.
+    '''
+
+    index = GeoIndex(airports)
+    result = {}
+    for w in workshops:
+        coords = get_coords(w)
+        if coords is None:
+            continue
+        nearby = []
+        seen = set()
+        for (distance, airport) in index.within(coords[0], coords[1], radius):
+            for person in airport.get('instructors') or []:
+                if (len(nearby) < length) and (person['user'] not in seen):
+                    seen.add(person['user'])
+                    nearby.append({'name' : person['name'],
+                                   'user' : person['user'],
+                                   'airport' : airport['iata'],
+                                   'distance' : int(round(distance))})
+            if len(nearby) >= length:
+                break
+        result[w['slug']] = nearby
+    return result
+
+#----------------------------------------
+
+def write_map_data(workshops, airports, today):
+    '''
+    Write maps/NAME-ZOOM.json for each zoom level of the upcoming
+    workshops, previous workshops and instructors maps.  Each file is
+    a compact JSON list of clusters (see util.cluster_points) whose
+    records are [title, URL, note, note URL].  Files are only rewritten if their
+    content changes.  Returns the number of files written and the
+    number of files.
+    '''
+
+    index = WorkshopIndex(workshops)
+    previous = index.window(last=today - datetime.timedelta(1))
+    previous.reverse()
+    layers = {
+        'upcoming' : map_workshops(index.upcoming(today)),
+        'previous' : map_workshops(previous),
+        'instructors' : map_instructors(airports)
+    }
+
+    os.makedirs(MAP_DIR, exist_ok=True)
+    changed = total = 0
+    for name in sorted(layers.keys()):
+        for (zoom, clusters) in enumerate(cluster_points(layers[name], MAP_MAX_ZOOM)):
+            text = json.dumps(clusters, ensure_ascii=False, separators=(',', ':'))
+            path = os.path.join(MAP_DIR, '{0}-{1}.json'.format(name, zoom))
+            if write_if_changed(path, text):
+                changed += 1
+            total += 1
+    return changed, total
+
+
+def map_workshops(workshops):
+    '''
+    Map points for workshops that have locations.  As on the workshop
+    pages, the venue links to the workshop's URL (or its page on this
+    site) and the date links to its page on this site.
+    '''
+    result = []
+    for w in workshops:
+        coords = get_coords(w)
+        if coords is not None:
+            path = w.get('path') or ''
+            result.append((coords[0], coords[1],
+                           [w['venue'], w.get('url') or path, w.get('humandate') or '', path]))
+    return result
+
+
+def map_instructors(airports):
+    '''Map points for instructors (placed at their airports).'''
+    result = []
+    for a in airports:
+        coords = get_coords(a)
+        if coords is None:
+            continue
+        for person in a.get('instructors') or []:
+            result.append((coords[0], coords[1],
+                           [person['name'], 'pages/team.html#{0}'.format(person['user']),
+                            a.get('fullname') or '', '']))
+    return result
+
+#----------------------------------------
+
+def harvest_blog(config, cache=None, workers=None):
+    '''Harvest metadata for all blog entries (using cache if provided).
 
     Note that the YAML parser reads times with a leading 0 like '09:00:00' as strings,
     not as times, so we have to convert manually.
     '''
 
-    all_meta = []
+    folders = []
+    posts = []
     for folder in glob.glob('blog/????/??'):
         for post in glob.glob('{0}/*.html'.format(folder)):
-            m = harvest_metadata(post)
-            m['folder'] = folder
-            fill_optional_metadata(m, 'favorite')
-            all_meta.append(m)
+            folders.append(folder)
+            posts.append(post)
+
+    all_meta = harvest_metadata_many(posts, workers, cache)
+    for (folder, m) in zip(folders, all_meta):
+        m['folder'] = folder
+        fill_optional_metadata(m, 'favorite')
 
     decorated = [(x['date'], x['time'], x) for x in all_meta]
     decorated.sort()
@@ -223,16 +380,18 @@ def organize_blog_entries(posts):
 
 #----------------------------------------
 
-def get_blog_excerpt(path):
-    '''Get excerpt from blog post for inclusion in blog index page.
+def get_blog_excerpt(path, cache=None):
+    '''Get excerpt from blog post for inclusion in blog index page
+    (using cache if provided).
     Have to turn newlines into spaces so that older versions of Jekyll
     (like the one on the server) won't turn them into single backslashes
     when doing inclusion expansion.'''
-    with open(path, 'r') as reader:
-        temp = reader.read()
-        temp = P_BLOG_EXCERPT.search(temp)
-        assert temp, 'Blog post {0} lacks excerpt'.format(path)
-        return temp.group(1).replace('\n', ' ')
+    if cache is not None:
+        content, excerpt = cache.get(path)
+    else:
+        content, excerpt = extract_blog_parts(path)
+    assert excerpt is not None, 'Blog post {0} lacks excerpt'.format(path)
+    return excerpt.replace('\n', ' ')
 
 #----------------------------------------
 
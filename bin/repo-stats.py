@@ -1,22 +1,59 @@
+#!/usr/bin/env python3
+'''
+Summarize recent activity on our repositories from the GitHub Archive.
+Usage: repo-stats.py [-s source_url] [-a archive_dir] [-j jobs] [-b bucket] [num_days]
+-s: base URL for hourly archives (default http://data.githubarchive.org/;
+    file:// URLs can be used for testing)
+-a: directory of previously-downloaded events (default _githubarchive)
+-j: number of hours to download at once (default 8)
+-b: width of trend buckets: hour, day (default) or week
+Hours already in the archive directory aren't downloaded again, so
+re-running for a longer window only fetches the new hours.
+'''
+
 __author__ = 'atlanmod'
 
 import sys
+import os
+import time
 import datetime
-import requests
-from cStringIO import StringIO
+import hashlib
+import urllib.request
+import urllib.error
 import gzip
 import re
 import json
-import yaml
+import calendar
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from itertools import repeat
+from operator import add, mul, sub, floordiv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from optparse import OptionParser
+from util import REPO_TRENDS, yaml_dump
 
 START_URL = 'http://data.githubarchive.org/'
 END_URL = '.json.gz'
 
 timeout_threshold = 5
 
-OUTPUT_EVENT_FILE = '/tmp/swcarpenter.json'
+# Local store of filtered events, one entry per hour.
+ARCHIVE_DIR = '_githubarchive'
+
+# Number of hours downloaded at once.
+DEFAULT_JOBS = 8
+
+# How many times to retry an hour, and the initial delay (in seconds)
+# before retrying, which doubles after each attempt.
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 1.0
+
 OUTPUT_STATS_FILE = 'stats.yml'
 OUTPUT_HTML_FILE = 'stats.html'
+OUTPUT_TRENDS_FILE = REPO_TRENDS
+OUTPUT_TRENDS_HTML = '_includes/repo_trends.html'
 
 REPOSITORIES = [
     'swcarpentry/shell-novice',
@@ -32,6 +69,13 @@ REPOSITORIES = [
     'swcarpentry/site'
 ]
 
+# Cheap test applied to raw (compressed-then-decompressed) lines before
+# JSON decoding: only lines mentioning one of our repositories can matter.
+REPOSITORY_PREFILTER = re.compile(b'|'.join(re.escape(r.encode('utf-8')) for r in REPOSITORIES))
+
+# Some hourly archives have several JSON objects on one line.
+JSON_RUN_ON = re.compile(r'}{"(?!\W)')
+
 EVENTS = [
     'IssueOpened',
     'IssueClosed',
@@ -41,14 +85,27 @@ EVENTS = [
     'PullRequestComment'
 ]
 
+# Positions of repositories and events in the columnar event store.
+REPOSITORY_INDEX = {r: i for (i, r) in enumerate(REPOSITORIES)}
+EVENT_INDEX = {e: i for (i, e) in enumerate(EVENTS)}
 
-def serialize_events(output_file, content):
-    output_file.write(content + '\n')
+# Width of weekly buckets in seconds.
+WEEK = 7 * 24 * 60 * 60
+
+# Widths of trend buckets in seconds, and how to label them.
+BUCKETS = {
+    'hour' : (60 * 60, '%Y-%m-%d %H:00'),
+    'day' : (24 * 60 * 60, '%Y-%m-%d'),
+    'week' : (WEEK, '%Y-%m-%d')
+}
+
+# Characters used to draw sparklines, from lowest to highest.
+SPARK_CHARS = u'\u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
 
 
 def serialize_stats(stats):
-    with open(OUTPUT_STATS_FILE, 'w+') as f:
-        yaml.dump(stats, f, encoding='utf-8', allow_unicode=True)
+    with open(OUTPUT_STATS_FILE, 'w', encoding='utf-8') as f:
+        yaml_dump(stats, f)
 
 
 def tablify_stats(stats):
@@ -57,10 +114,10 @@ def tablify_stats(stats):
         print('<tr><th>Project</th><th colspan="3">Issues</th><th colspan="3">Pull Requests</th></tr>', file=f)
         print('<tr><th></th><th>Opened</th><th>Closed</th><th>Comments</th><th>Opened</th><th>Closed</th><th>Comments</th></tr>', file=f)
         for r in REPOSITORIES:
-            print('<tr><td>{0}</td>'.format(r.replace('swcarpentry/','')),, file=f)
+            print('<tr><td>{0}</td>'.format(r.replace('swcarpentry/','')), end='', file=f)
             for e in EVENTS:
                 val = stats.get(r, {e:''}).get(e, '')
-                print('<td>{0}</td>'.format(val),, file=f)
+                print('<td>{0}</td>'.format(val), end='', file=f)
             print('</tr>', file=f)
         print('</table>', file=f)
 
@@ -75,48 +132,150 @@ def get_githubarchive_format(date):
     return output_format
 
 
-def get_data_from_date_to_date(starting_date, ending_date):
-    #open file to store the repo information
-    event_file = open(OUTPUT_EVENT_FILE, 'w+')
-
-    #iterate over all github events between the starting day and today
-    current_date = starting_date
-    while current_date != ending_date:
-        print('processing: {0}'.format(current_date))
-        url = u'http://data.githubarchive.org/{0}.json.gz'.format(get_githubarchive_format(current_date))
+def get_data_from_date_to_date(starting_date, ending_date, source=START_URL,
+                               archive_dir=ARCHIVE_DIR, jobs=DEFAULT_JOBS):
+    '''
+    Make sure the filtered events for every hour in [starting_date,
+    ending_date) are in the local archive and loaded into its columnar
+    store, and return the latter.
+    '''
+    hours = get_hours(starting_date, ending_date)
+    archive = EventArchive(archive_dir)
+    missing = archive.update(hours, source, jobs)
+    if missing:
+        print('Missing hours (not retrieved): {0}'.format(' '.join(missing)), file=sys.stderr)
+    columns = EventColumns(os.path.join(archive_dir, 'columns'))
+    columns.add_hours(archive, hours)
+    columns.save()
+    return columns
+
+
+def get_hours(starting_date, ending_date):
+    '''List the hours (as "%Y-%m-%d-%H") from starting_date up to but not including ending_date.'''
+    result = []
+    current = datetime.datetime.strptime(starting_date, "%Y-%m-%d-%H")
+    end = datetime.datetime.strptime(ending_date, "%Y-%m-%d-%H")
+    while current < end:
+        result.append(current.strftime("%Y-%m-%d-%H"))
+        current += datetime.timedelta(hours=1)
+    return result
+
+
+def fetch_hour(hour, source=START_URL):
+    '''
+    Get the filtered events for one hour as newline-terminated JSON text,
+    retrying with exponential backoff.  Returns None if the hour can't
+    be retrieved (including if it doesn't exist yet).
+    '''
+    url = u'{0}{1}{2}'.format(source, get_githubarchive_format(hour), END_URL)
+    delay = FETCH_BACKOFF
+    for attempt in range(FETCH_RETRIES + 1):
         try:
-            response = requests.get(url, timeout=timeout_threshold)
-            results = gzip.GzipFile(fileobj=StringIO(response.content))
-            data = results.read()
-            for line in data.split('\n'):
-                line_unicoded = unicode(line, errors='ignore')
-                line_predecoded = re.sub(r'}{"(?!\W)', '}JSONDELIMITER{"', line_unicoded)
-                for line_decoded in line_predecoded.split('JSONDELIMITER'):
-                    if len(line_decoded) > 0:
-                        try:
-                            github_event = json.loads(line_decoded)
-                            repository = github_event.get("repo")
-
-                            if repository is not None:
-                                name = repository.get("name")
-                                #look for your repository events
-                                if name in REPOSITORIES:
-                                    #serialize the events into the event file
-                                    serialize_events(event_file, line_decoded)
-                            else:
-                                sys.stderr.write(github_event)
-                        except:
-                            sys.stderr.write("JSON failed:" + line_decoded)
-        except:
-            sys.stderr.write(url + ' timeout exceeded, data not retrieved!')
-
-        #update current date
-        d = datetime.datetime.strptime(current_date, "%Y-%m-%d-%H")
-        d = d + datetime.timedelta(hours=1)
-        current_date = d.strftime("%Y-%m-%d-%H")
-
-    #close file
-    event_file.close()
+            return ''.join(line + '\n' for line in stream_repository_events(url))
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                print('{0}: not found'.format(url), file=sys.stderr)
+                return None
+            error = e
+        except (OSError, EOFError) as e:
+            error = e
+        if attempt < FETCH_RETRIES:
+            time.sleep(delay)
+            delay *= 2
+    print('{0}: data not retrieved ({1})'.format(url, str(error)), file=sys.stderr)
+    return None
+
+
+class EventArchive(object):
+    '''
+    Local store of filtered events.  Each hour's events are saved in
+    objects/<sha1>.json (so identical hours, such as empty ones, share
+    storage), and index.json maps each retrieved hour to its object.
+    Hours already in the index are never downloaded again.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.index_path = os.path.join(root, 'index.json')
+        os.makedirs(self.objects, exist_ok=True)
+        self.index = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as reader:
+                self.index = json.load(reader)
+
+    def has(self, hour):
+        return hour in self.index
+
+    def get(self, hour):
+        with open(self.object_path(self.index[hour]), 'r', encoding='utf-8') as reader:
+            return reader.read()
+
+    def put(self, hour, content):
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.isfile(path):
+            with open(path + '.tmp', 'w', encoding='utf-8') as writer:
+                writer.write(content)
+            os.replace(path + '.tmp', path)
+        self.index[hour] = digest
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest + '.json')
+
+    def save(self):
+        with open(self.index_path + '.tmp', 'w') as writer:
+            json.dump(self.index, writer, indent=0, sort_keys=True)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def update(self, hours, source=START_URL, jobs=DEFAULT_JOBS):
+        '''
+        Download hours that aren't in the archive yet, at most 'jobs' at
+        a time, saving the index as each one arrives.  Returns the
+        (sorted) list of hours that couldn't be retrieved.
+        '''
+        todo = [h for h in hours if not self.has(h)]
+        print('{0} of {1} hours already archived'.format(len(hours) - len(todo), len(hours)))
+        missing = []
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            futures = {pool.submit(fetch_hour, h, source) : h for h in todo}
+            for f in as_completed(futures):
+                hour, content = futures[f], f.result()
+                if content is None:
+                    missing.append(hour)
+                else:
+                    print('processed: {0}'.format(hour))
+                    self.put(hour, content)
+                    self.save()
+        return sorted(missing)
+
+
+def stream_repository_events(url):
+    '''
+    Yield the JSON text of events for our repositories from one hourly
+    archive, decompressing the response as it arrives rather than
+    buffering it, and only decoding lines that mention one of our
+    repositories.
+    '''
+    with urllib.request.urlopen(url, timeout=timeout_threshold) as response:
+        with gzip.GzipFile(fileobj=response) as results:
+            for raw in results:
+                if not REPOSITORY_PREFILTER.search(raw):
+                    continue
+                line = raw.decode('utf-8', errors='ignore').rstrip('\n')
+                for line_decoded in JSON_RUN_ON.sub('}JSONDELIMITER{"', line).split('JSONDELIMITER'):
+                    if not line_decoded:
+                        continue
+                    try:
+                        github_event = json.loads(line_decoded)
+                    except ValueError:
+                        print('JSON failed: {0}'.format(line_decoded), file=sys.stderr)
+                        continue
+                    repository = github_event.get("repo")
+                    if repository is None:
+                        print('No repository: {0}'.format(line_decoded), file=sys.stderr)
+                    elif repository.get("name") in REPOSITORIES:
+                        yield line_decoded
 
 
 def process_pullrequest(event):
@@ -175,53 +334,265 @@ def process_event(event_type, event):
         info = process_issue_comment(event)
     else:
         info = {'type': 'not_treated'}
-        sys.stderr.write(event_type + " not treated!")
+        print(event_type + " not treated!", file=sys.stderr)
 
     return info
 
 
-def update_stats(stats, repo, info):
-    type = info.get('type')
-    if type != 'not_treated':
-        if stats.get(repo):
-            repo_stats = stats.get(repo)
-            if repo_stats.get(type):
-                counter = repo_stats.get(type)
-                repo_stats.update({type: counter+1})
-            else:
-                repo_stats.update({type: 1})
-                stats.update({repo: repo_stats})
-        else:
-            repo_stats = {type: 1}
-            stats.update({repo: repo_stats})
+class EventColumns(object):
+    '''
+    Compact columnar copy of the archived events we count, sorted by
+    time: one array each of timestamps (seconds since the epoch),
+    repository indices (into REPOSITORIES) and event kinds (indices into
+    EVENTS), plus the list of hours that have been loaded.  Windows are
+    found by bisecting the timestamp array, and counts are computed
+    with a single Counter pass over combined repository/kind keys.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.times = self.load('times', 'q')
+        self.repos = self.load('repos', 'B')
+        self.kinds = self.load('kinds', 'B')
+        self.hours = set()
+        self.changed_since = None
+        hours_path = os.path.join(root, 'hours.json')
+        if os.path.isfile(hours_path):
+            with open(hours_path, 'r') as reader:
+                self.hours = set(json.load(reader))
+        if not (len(self.times) == len(self.repos) == len(self.kinds)):
+            print('Inconsistent event columns in {0}: rebuilding'.format(root), file=sys.stderr)
+            self.times, self.repos, self.kinds = array('q'), array('B'), array('B')
+            self.hours = set()
+
+    def load(self, name, typecode):
+        result = array(typecode)
+        path = os.path.join(self.root, name + '.bin')
+        if os.path.isfile(path):
+            with open(path, 'rb') as reader:
+                result.frombytes(reader.read())
+        return result
+
+    def save(self):
+        for (name, column) in (('times', self.times), ('repos', self.repos), ('kinds', self.kinds)):
+            path = os.path.join(self.root, name + '.bin')
+            with open(path + '.tmp', 'wb') as writer:
+                column.tofile(writer)
+            os.replace(path + '.tmp', path)
+        with open(os.path.join(self.root, 'hours.json'), 'w') as writer:
+            json.dump(sorted(self.hours), writer)
+
+    def add_hours(self, archive, hours):
+        '''
+        Load events for hours that aren't already in the columns,
+        recording the earliest new event time in changed_since.  Only
+        the new rows are sorted: normally they all come after the stored
+        events and are simply appended, and otherwise they are merged
+        with the stored events from the first new time onward.
+        '''
+        new = []
+        for hour in hours:
+            if (hour in self.hours) or not archive.has(hour):
+                continue
+            default_time = hour_to_epoch(hour)
+            for line in archive.get(hour).splitlines():
+                event = json.loads(line)
+                kind = process_event(event.get('type'), event).get('type')
+                if kind in EVENT_INDEX:
+                    new.append((event_time(event, default_time),
+                                REPOSITORY_INDEX[event['repo']['name']],
+                                EVENT_INDEX[kind]))
+            self.hours.add(hour)
+        if not new:
+            return
+        earliest = min(r[0] for r in new)
+        if (self.changed_since is None) or (earliest < self.changed_since):
+            self.changed_since = earliest
+        new.sort()
+        pos = bisect_right(self.times, earliest)
+        if pos < len(self.times):
+            new = list(heapq.merge(zip(self.times[pos:], self.repos[pos:], self.kinds[pos:]), new))
+            del self.times[pos:], self.repos[pos:], self.kinds[pos:]
+        self.times.extend(r[0] for r in new)
+        self.repos.extend(r[1] for r in new)
+        self.kinds.extend(r[2] for r in new)
+
+    def window(self, start, end):
+        '''Return the slice bounds of events with start <= time < end.'''
+        return bisect_left(self.times, start), bisect_left(self.times, end)
+
+    def counts(self, start, end):
+        '''Count events by repository and kind in [start, end): {repo: {event: n}}.'''
+        lo, hi = self.window(start, end)
+        keys = map(add, map(mul, self.repos[lo:hi], repeat(len(EVENTS))), self.kinds[lo:hi])
+        stats = {}
+        for (key, n) in Counter(keys).items():
+            repo, kind = divmod(key, len(EVENTS))
+            stats.setdefault(REPOSITORIES[repo], {})[EVENTS[kind]] = n
+        return stats
+
+    def bucket_counts(self, start, end, width):
+        '''
+        Count events by bucket, repository and kind in [start, end),
+        where buckets are 'width' seconds wide starting at 'start':
+        {bucket_start: {repo: {event: n}}}.
+        '''
+        lo, hi = self.window(start, end)
+        combined = len(REPOSITORIES) * len(EVENTS)
+        buckets = map(floordiv, map(sub, self.times[lo:hi], repeat(start)), repeat(width))
+        keys = map(add, map(mul, buckets, repeat(combined)),
+                   map(add, map(mul, self.repos[lo:hi], repeat(len(EVENTS))), self.kinds[lo:hi]))
+        result = {}
+        for (key, n) in Counter(keys).items():
+            bucket, rest = divmod(key, combined)
+            repo, kind = divmod(rest, len(EVENTS))
+            result.setdefault(start + bucket * width, {}) \
+                  .setdefault(REPOSITORIES[repo], {})[EVENTS[kind]] = n
+        return result
+
+
+def hour_to_epoch(hour):
+    '''Convert an hour string ("%Y-%m-%d-%H", UTC) to seconds since the epoch.'''
+    return calendar.timegm(datetime.datetime.strptime(hour, "%Y-%m-%d-%H").timetuple())
+
+
+def event_time(event, default):
+    '''Get an event's creation time in seconds since the epoch.'''
+    try:
+        created = datetime.datetime.strptime(event['created_at'][:19], "%Y-%m-%dT%H:%M:%S")
+        return calendar.timegm(created.timetuple())
+    except (KeyError, TypeError, ValueError):
+        return default
+
+
+def get_repo_stats(columns, starting_date, ending_date):
+    start, end = hour_to_epoch(starting_date), hour_to_epoch(ending_date)
+    stats = columns.counts(start, end)
+    weekly = columns.bucket_counts(start, end, WEEK)
+    serialize_stats({'total': stats,
+                     'weekly': {datetime.datetime.utcfromtimestamp(k).strftime('%Y-%m-%d') : v
+                                for (k, v) in weekly.items()}})
+    tablify_stats(stats)
     return
 
 
-def get_repo_stats():
-    stats = {}
-    event_file = open(OUTPUT_EVENT_FILE, 'r')
-    for line in event_file:
-        event = json.loads(line)
-        event_type = event.get('type')
-        repo_name = event.get('repo').get('name')
-        info = process_event(event_type, event)
-        update_stats(stats, repo_name, info)
-    event_file.close()
-    #serialize_stats(stats)
-    tablify_stats(stats)
-    return
+def update_trends(columns, start, end, width, state_path):
+    '''
+    Return {bucket_start: {repo: {event: n}}} for buckets of 'width'
+    seconds (aligned to multiples of width) covering [start, end).
+    Bucket counts are saved in state_path between runs, and only
+    buckets that may have changed are recomputed: those before the
+    range covered last time, those from the end of that range onward
+    (the last one was probably partial), and those at or after the
+    earliest newly-loaded event.
+    '''
+    first = (start // width) * width
+    state = None
+    if os.path.isfile(state_path):
+        with open(state_path, 'r') as reader:
+            state = json.load(reader)
+        if state['width'] != width:
+            state = None
+
+    if state is None:
+        counts = columns.bucket_counts(first, end, width)
+        covered = [first, end]
+    else:
+        counts = {int(k) : v for (k, v) in state['counts'].items()}
+        lo, hi = state['covered']
+        redo = (hi // width) * width
+        if columns.changed_since is not None:
+            redo = min(redo, (columns.changed_since // width) * width)
+        if first < lo:
+            counts.update(columns.bucket_counts(first, lo, width))
+            lo = first
+        counts = {k : v for (k, v) in counts.items() if k < redo}
+        counts.update(columns.bucket_counts(max(redo, lo), end, width))
+        covered = [lo, max(hi, end)]
+
+    with open(state_path + '.tmp', 'w') as writer:
+        json.dump({'width' : width, 'covered' : covered, 'counts' : counts}, writer)
+    os.replace(state_path + '.tmp', state_path)
+
+    return {k : counts.get(k, {}) for k in range(first, end, width)}
+
+
+def serialize_trends(trends, label):
+    '''Write bucketed counts as per-repository, per-event series for _config.yml.'''
+    starts = sorted(trends.keys())
+    series = {}
+    for r in REPOSITORIES:
+        series[r] = {e : [trends[s].get(r, {}).get(e, 0) for s in starts] for e in EVENTS}
+    with open(OUTPUT_TRENDS_FILE, 'w', encoding='utf-8') as f:
+        yaml_dump({'buckets' : [format_epoch(s, label) for s in starts],
+                   'series' : series}, f)
+    return series
+
+
+def sparkline(values):
+    '''Draw a list of counts as a string of block characters.'''
+    top = max(values) if values else 0
+    if not top:
+        return SPARK_CHARS[0] * len(values)
+    scale = len(SPARK_CHARS) - 1
+    return u''.join(SPARK_CHARS[(v * scale + top - 1) // top] for v in values)
+
+
+def tablify_trends(series, first, last):
+    with open(OUTPUT_TRENDS_HTML, 'w', encoding='utf-8') as f:
+        print('<table class="table table-striped">', file=f)
+        print('<tr><th>Project</th><th>Event</th><th>{0} &ndash; {1}</th><th>Total</th></tr>'.format(first, last), file=f)
+        for r in REPOSITORIES:
+            for e in EVENTS:
+                values = series[r][e]
+                print('<tr><td>{0}</td><td>{1}</td><td class="sparkline">{2}</td><td>{3}</td></tr>'.format(
+                    r.replace('swcarpentry/',''), e, sparkline(values), sum(values)), file=f)
+        print('</table>', file=f)
+
+
+def format_epoch(seconds, label):
+    return datetime.datetime.utcfromtimestamp(seconds).strftime(label)
+
+
+def get_repo_trends(columns, archive_dir, starting_date, ending_date, bucket):
+    width, label = BUCKETS[bucket]
+    start, end = hour_to_epoch(starting_date), hour_to_epoch(ending_date)
+    trends = update_trends(columns, start, end, width,
+                           os.path.join(archive_dir, 'trends-{0}.json'.format(bucket)))
+    series = serialize_trends(trends, label)
+    starts = sorted(trends.keys())
+    if starts:
+        tablify_trends(series, format_epoch(starts[0], label), format_epoch(starts[-1], label))
+
+
+def parse_args():
+    parser = OptionParser()
+    parser.add_option('-s', '--source', dest='source', default=START_URL,
+                      help='base URL of hourly archives')
+    parser.add_option('-a', '--archive', dest='archive', default=ARCHIVE_DIR,
+                      help='directory of previously-downloaded events')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=DEFAULT_JOBS,
+                      help='number of hours to download at once')
+    parser.add_option('-b', '--bucket', dest='bucket', default='day',
+                      choices=sorted(BUCKETS.keys()),
+                      help='width of trend buckets (hour, day or week)')
+    return parser.parse_args()
 
 
 def main():
+    options, args = parse_args()
     num_days = 7
-    if len(sys.argv) > 1:
-        num_days = int(sys.argv[1])
+    if args:
+        num_days = int(args[0])
     end_date = datetime.datetime.today()
     start_date = end_date - datetime.timedelta(days=num_days)
     end_date = end_date.strftime("%Y-%m-%d-%H")
     start_date = start_date.strftime("%Y-%m-%d-%H")
-    get_data_from_date_to_date(start_date, end_date)
-    get_repo_stats()
+    columns = get_data_from_date_to_date(start_date, end_date, options.source,
+                                         options.archive, options.jobs)
+    get_repo_stats(columns, start_date, end_date)
+    get_repo_trends(columns, options.archive, start_date, end_date, options.bucket)
 
 if __name__ == "__main__":
     main()
@@ -2,11 +2,17 @@
 '''Check the index.html data of a workshop given its URL.'''
 
 import sys
-from workshops import fetch, check_info, convert_url
+from workshops import fetch, check_info, convert_url, fail, FetchCache, FetchError
+from util import FETCH_CACHE
 
 assert len(sys.argv) == 2, 'Usage: url-check.py url'
 url = convert_url(sys.argv[1])
-info = fetch(url)
+cache = FetchCache(FETCH_CACHE)
+try:
+    info = fetch(url, cache=cache)
+except FetchError as e:
+    fail('{0}', e)
+cache.save()
 info['url'] = url
 if check_info(url, info):
     print(url)
@@ -2,12 +2,19 @@
 '''Get instructors and helpers given workshop URL.'''
 
 import sys
-from workshops import fetch, check_info, convert_url
+from workshops import fetch, convert_url, fail, FetchCache, FetchError
+from util import FETCH_CACHE
 
+cache = FetchCache(FETCH_CACHE)
 for url in sys.argv[1:]:
     url = convert_url(url)
-    info = fetch(url)
+    try:
+        info = fetch(url, cache=cache)
+    except FetchError as e:
+        fail('{0}', e)
     print(url)
     for key in ('instructor', 'helper'):
         for item in info[key]:
             print(key, item)
+cache.save()
+print(cache.report(), file=sys.stderr)
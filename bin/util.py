@@ -6,14 +6,42 @@ Utilities for site regeneration.
 import sys
 import os
 import re
+import copy
+import time
+import hashlib
+import pickle
+import threading
+import bisect
+import math
+import calendar
+import datetime
+import email.utils
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import urllib.request
+import urllib.error
 import ssl
 import yaml
-from PyRSS2Gen import RSS2, RSSItem
+from xml.sax.saxutils import escape, quoteattr
+
+# Use libyaml's C loader and dumper if available.  Both are "safe"
+# (plain data only), and resolve dates and times exactly as the
+# pure-Python versions do, so a quoted time like "09:00:00" in a blog
+# post's header is still a string and an unquoted date is still a date.
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
 
 # Standard name for metadata files.
 CONFIG_YML = '_config.yml'
 
+# Pickled copy of _config.yml for scripts that run after preprocessing.
+CONFIG_SIDECAR = '_config.pickle'
+
+# Format version of the sidecar (bump when its layout changes).
+SIDECAR_VERSION = 1
+
 # Template for metadata (in config directory).
 STANDARD_YML = 'standard.yml'
 
@@ -38,92 +66,1049 @@ WORKSHOP_CACHE = '_workshop_cache.yml'
 # File containing cached information about issues and pull requests.
 DASHBOARD_CACHE = '_dashboard_cache.yml'
 
+# File containing per-repository issue state used to update DASHBOARD_CACHE.
+DASHBOARD_STATE = '_dashboard_state.pickle'
+
+# File containing per-repository activity trends (made by repo-stats.py).
+REPO_TRENDS = '_repo_trends.yml'
+
+# File containing cached blog metadata (keyed by path, mtime and hash).
+HARVEST_CACHE = '_harvest_cache.pickle'
+
+# File containing cached workshop index.html headers (keyed by URL).
+FETCH_CACHE = '_fetch_cache.pickle'
+
+# File containing cached blog post content and excerpts (keyed by digest of each file).
+EXTRACT_CACHE = '_extract_cache.pickle'
+
+# File recording the inputs each blog archive feed page was built from.
+ARCHIVE_STATE = '_archive_state.pickle'
+
+# File containing cached exports from AMY (keyed by URL).
+AMY_CACHE = '_amy_cache.pickle'
+
+# Timeout (in seconds) for requests to AMY.
+AMY_TIMEOUT = 60
+
+# Don't bother starting worker processes for fewer files than this.
+HARVEST_PARALLEL_MIN = 64
+
+# Mean radius of the Earth (km) for great-circle distances.
+EARTH_RADIUS_KM = 6371.0088
+
+# Size (degrees of latitude and longitude) of the cells in a GeoIndex.
+GEO_CELL_DEGREES = 2.0
+
+# Directory (in the site source) for pre-clustered map markers, the
+# highest zoom level clustered, the size (pixels) of the clustering grid,
+# and the largest cluster whose members are listed individually.
+MAP_DIR = 'maps'
+MAP_MAX_ZOOM = 10
+MAP_GRID_PIXELS = 40
+MAP_CLUSTER_LIST = 20
+
+# Largest latitude shown on Web Mercator maps.
+MERCATOR_MAX_LAT = 85.05112878
+
+# XML namespaces for Atom and RFC 5005 feed history (paged archives).
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+FEED_HISTORY_NS = 'http://purl.org/syndication/history/1.0'
+
 # Patterns used to extract content and excerpts from compiled blog
-# entries.  Using regular expressions is a hack, but is *much* simpler
-# than trying to parse and un-parse the not-quite HTML.
+# entries.  These are kept as the reference for extract_marked (which
+# does the same job without backtracking over the whole file) and are
+# used by bin/bench-blog-extract.py.
 P_BLOG_CONTENT = re.compile(r'<!--\s+start\s+content\s+-->\s+(.+)\s+<!--\s+end\s+content\s+-->', re.DOTALL)
 P_BLOG_EXCERPT = re.compile(r'<!--\s+start\s+excerpt\s+-->\s+(.+)\s+<!--\s+end\s+excerpt\s+-->', re.DOTALL)
 
 #----------------------------------------
 
-def harvest_metadata(filename):
-    '''Harvest metadata from a single file.'''
+def harvest_metadata(filename, cache=None):
+    '''Harvest metadata from a single file, consulting cache if given.'''
+
+    if cache is not None:
+        return cache.harvest(filename)
+    return parse_metadata(filename, read_front_matter_file(filename))
+
+
+def harvest_metadata_many(filenames, workers=None, cache=None):
+    '''
+    Harvest metadata from many files, returning results in the same
+    order as the filenames.  Files that aren't in the cache are parsed
+    in a pool of 'workers' processes (default: one per CPU) unless
+    there are only a few of them.
+    '''
+
+    results = [None] * len(filenames)
+    pending = []
+    for (i, filename) in enumerate(filenames):
+        meta = None if (cache is None) else cache.lookup(filename)
+        if meta is None:
+            pending.append(i)
+        else:
+            results[i] = meta
+
+    todo = [filenames[i] for i in pending]
+    if (workers == 1) or (len(todo) < HARVEST_PARALLEL_MIN):
+        entries = [_harvest_entry(f) for f in todo]
+    else:
+        workers = workers or os.cpu_count() or 1
+        chunksize = max(1, len(todo) // (4 * workers))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            entries = list(pool.map(_harvest_entry, todo, chunksize=chunksize))
+
+    for (i, entry) in zip(pending, entries):
+        if cache is not None:
+            cache.store(filenames[i], entry)
+        results[i] = dict(entry['meta'])
+    return results
+
+
+def _harvest_entry(filename):
+    '''Read and parse a single file, returning a cache entry.'''
+
+    status = os.stat(filename)
+    header = read_front_matter_file(filename)
+    return {'digest' : front_matter_digest(header),
+            'mtime' : status.st_mtime_ns,
+            'size' : status.st_size,
+            'meta' : parse_metadata(filename, header)}
+
+
+def parse_metadata(filename, header):
+    '''Parse a YAML header (as returned by read_front_matter).'''
 
     try:
-        with open(filename, 'r') as reader:
-            text = reader.read()
-            stuff = text.split('---')[1]
-            meta_dict = yaml.load(stuff)
-            meta_dict['path'] = filename
-            return meta_dict
+        if header is None:
+            raise ValueError('no YAML header delimited by "---" lines')
+        meta_dict = yaml_load(header)
+        meta_dict['path'] = filename
+        return meta_dict
     except Exception as e:
-        print >> sys.stderr, 'Failed to harvest metadata from "{0}": {1}'.format(filename, str(e))
+        print('Failed to harvest metadata from "{0}": {1}'.format(filename, str(e)), file=sys.stderr)
         raise e
 
+
+def read_front_matter(lines):
+    '''
+    Return the YAML block between the opening '---' line (which must be
+    the first line) and the closing '---' line from an iterable of lines,
+    or None if there isn't one.  Stops consuming lines at the closing
+    delimiter, so the body of a post is never read.
+    '''
+
+    lines = iter(lines)
+    if next(lines, '').rstrip() != '---':
+        return None
+    block = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line.rstrip() == '---':
+            return '\n'.join(block) + '\n'
+        block.append(line)
+    return None
+
+
+def read_front_matter_file(filename):
+    '''Read just the YAML header from a file.'''
+
+    with open(filename, 'r', encoding='utf-8') as reader:
+        return read_front_matter(reader)
+
+
+def front_matter_digest(header):
+    '''Return the SHA-1 hex digest of a YAML header (None for no header).'''
+
+    return hashlib.sha1((header or '').encode('utf-8')).hexdigest()
+
+
+def file_digest(filename):
+    '''Return the SHA-1 hex digest of a file's content.'''
+
+    with open(filename, 'rb') as reader:
+        return hashlib.sha1(reader.read()).hexdigest()
+
+#----------------------------------------
+
+class HarvestCache(object):
+    '''
+    Persistent cache of harvested metadata.  Entries are keyed by path
+    and are reused if the file's mtime and size are unchanged, or if
+    the hash of its YAML header is unchanged (e.g., after a fresh
+    checkout or an edit to the body of a post).  The
+    whole cache is discarded if 'stamp' differs from the saved one.
+    '''
+
+    VERSION = 2
+
+    def __init__(self, path, stamp=None):
+        self.path = path
+        self.stamp = stamp
+        self.entries = {}
+        self.seen = set()
+        self.hits = 0
+        self.misses = 0
+        saved = load_pickle(path, self.VERSION)
+        if saved and (saved['stamp'] == stamp):
+            self.entries = saved['entries']
+
+    def harvest(self, filename):
+        '''Return (a copy of) the metadata for filename.'''
+        meta = self.lookup(filename)
+        if meta is None:
+            entry = _harvest_entry(filename)
+            self.store(filename, entry)
+            meta = dict(entry['meta'])
+        return meta
+
+    def lookup(self, filename):
+        '''Return (a copy of) cached metadata for filename, or None.'''
+        self.seen.add(filename)
+        entry = self.entries.get(filename)
+        if not entry:
+            return None
+        status = os.stat(filename)
+        if (entry['mtime'], entry['size']) != (status.st_mtime_ns, status.st_size):
+            if front_matter_digest(read_front_matter_file(filename)) != entry['digest']:
+                return None
+            entry['mtime'], entry['size'] = status.st_mtime_ns, status.st_size
+        self.hits += 1
+        return dict(entry['meta'])
+
+    def store(self, filename, entry):
+        '''Record a freshly-harvested entry.'''
+        self.seen.add(filename)
+        self.misses += 1
+        self.entries[filename] = entry
+
+    def save(self):
+        '''Save entries for files seen in this run (atomically).'''
+        saved = {'version' : self.VERSION,
+                 'stamp' : self.stamp,
+                 'entries' : {k : self.entries[k] for k in self.seen if k in self.entries}}
+        save_pickle(self.path, saved)
+
+    def report(self):
+        '''Return a one-line summary of cache performance.'''
+        return 'harvest cache: {0} hits, {1} misses'.format(self.hits, self.misses)
+
 #----------------------------------------
 
 def load_info(folder, filename=CONFIG_YML):
-    '''Load metadata info file from specified directory and return content.'''
+    '''
+    Load metadata info file from specified directory and return content.
+    For _config.yml, use the pickled sidecar instead if it is fresh.
+    '''
     path = os.path.join(folder, filename)
     assert os.path.isfile(path), \
            'No info file found in folder "{0}"'.format(folder)
-    with open(path, 'r') as reader:
-        return yaml.load(reader)
+    if filename == CONFIG_YML:
+        config = load_sidecar(os.path.join(folder, CONFIG_SIDECAR), path)
+        if config is not None:
+            return config
+    with open(path, 'r', encoding='utf-8') as reader:
+        return yaml_load(reader)
+
+
+def save_sidecar(sidecar_path, source_path, config):
+    '''Save a pickled copy of config that was just written to source_path.'''
+    save_pickle(sidecar_path, {'version' : SIDECAR_VERSION,
+                               'source_hash' : file_digest(source_path),
+                               'config' : config})
+
+
+def load_sidecar(sidecar_path, source_path):
+    '''
+    Return the config saved in a sidecar, or None if the sidecar is
+    missing, unreadable, from another version, or doesn't match the
+    current content of source_path.
+    '''
+    saved = load_pickle(sidecar_path, SIDECAR_VERSION)
+    if saved and (saved['source_hash'] == file_digest(source_path)):
+        return saved['config']
+    return None
+
+
+def load_pickle(path, version):
+    '''
+    Load data saved by save_pickle, returning None if the file is
+    missing or unreadable, or if its 'version' entry doesn't match.
+    '''
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as reader:
+            saved = pickle.load(reader)
+        if saved['version'] == version:
+            return saved
+    except Exception as e:
+        print('Ignoring unreadable cache file "{0}": {1}'.format(path, str(e)), file=sys.stderr)
+    return None
+
+
+def write_if_changed(path, text):
+    '''
+    Write text to path (as UTF-8) unless the file already has exactly
+    that content, so that its timestamp (and anything that depends on
+    it) is left alone.  Returns True if the file was written.
+    '''
+    data = text.encode('utf-8')
+    if os.path.isfile(path):
+        with open(path, 'rb') as reader:
+            if reader.read() == data:
+                return False
+    temp = path + '.tmp'
+    with open(temp, 'wb') as writer:
+        writer.write(data)
+    os.replace(temp, path)
+    return True
+
+
+def save_pickle(path, data):
+    '''Pickle data to path atomically (via a temporary file).'''
+    temp = path + '.tmp'
+    with open(temp, 'wb') as writer:
+        pickle.dump(data, writer, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, path)
 
 
-def fetch_info(base_url, url):
-    """Download a file and save it."""
+class OfflineError(Exception):
+    '''An offline build needs a download that hasn't been cached.'''
+
+
+def fetch_info(base_url, url, cache=None, max_age=None, offline=False):
+    """
+    Download a YAML file and return its content.  If a cache is given,
+    the request is conditional; the cached copy is used without asking
+    the server if it is less than max_age seconds old (or if offline),
+    and as a fallback if the server can't be reached.  Raises
+    OfflineError if offline and there is no cached copy.
+    """
 
     address = base_url + url
 
+    if offline and ((cache is None) or (cache.age(address) is None)):
+        raise OfflineError('No cached copy of "{0}" for offline build: '
+                           'run once without --offline to fetch it'.format(address))
+
+    if cache is not None:
+        age = cache.age(address)
+        if offline:
+            return cache.get(address)
+        if (age is not None) and (max_age is not None) and (age <= max_age):
+            return cache.get(address)
+
+    headers = cache.conditional_headers(address) if (cache is not None) else {}
+    request = urllib.request.Request(address, headers=headers)
+    kwargs = {'timeout' : AMY_TIMEOUT}
     which_python = sys.version_info[:3]
-    if which_python <= (3, 4, 2):
-        with urllib.request.urlopen(address) as f:
+    if which_python > (3, 4, 2):
+        kwargs['context'] = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    try:
+        with urllib.request.urlopen(request, **kwargs) as f:
             content = f.read()
-    else:
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
-        with urllib.request.urlopen(address, context=ssl_context) as f:
-                content = f.read()
+            info = yaml_load(content.decode('utf-8'))
+            if cache is not None:
+                cache.store(address, f, info)
+            return info
+    except urllib.error.HTTPError as e:
+        if (e.code == 304) and (cache is not None):
+            return cache.hit(address)
+        return _cached_fallback(cache, address, e)
+    except OSError as e:
+        # URLError (connection failures) and read timeouts both land here.
+        return _cached_fallback(cache, address, e)
+
+
+def _cached_fallback(cache, address, error):
+    '''
+    Return the cached copy of address after a failed fetch, with a
+    warning, or re-raise the error if there isn't one.
+    '''
+    if (cache is None) or (cache.age(address) is None):
+        raise error
+    reason = getattr(error, 'reason', None) or str(error)
+    print('Unable to fetch "{0}" ({1}): using cached copy'.format(address, reason), file=sys.stderr)
+    return cache.get(address)
+
+def fetch_info_many(base_url, urls, cache=None, max_age=None, offline=False):
+    '''Fetch several files concurrently with fetch_info, returning results in order.'''
+
+    with ThreadPoolExecutor(max_workers=max(1, len(urls))) as pool:
+        return list(pool.map(lambda u: fetch_info(base_url, u, cache, max_age, offline), urls))
+
+#----------------------------------------
+
+class FetchCache(object):
+    '''
+    On-disk cache of parsed downloads (workshop headers, AMY exports)
+    keyed by URL.  Each entry records the ETag and Last-Modified headers
+    of the response the data was parsed from, so that later fetches can
+    be conditional and re-use the parsed data when the server says it
+    hasn't changed.  Works with both 'requests' and 'urllib' responses.
+    '''
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        saved = load_pickle(path, self.VERSION)
+        self.entries = saved['entries'] if saved else {}
+        self.requests = 0
+        self.hits = 0
+        self.reused = 0
+        self.bytes_saved = 0
+
+    def conditional_headers(self, url):
+        '''Headers to make a request for url conditional.'''
+        with self.lock:
+            self.requests += 1
+            entry = self.entries.get(url)
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def age(self, url):
+        '''Seconds since url was last fetched (or None if not cached).'''
+        entry = self.entries.get(url)
+        return (time.time() - entry['fetched']) if entry else None
+
+    def get(self, url):
+        '''Return (a copy of) the cached info for url without revalidating it.'''
+        with self.lock:
+            self.reused += 1
+            return copy.deepcopy(self.entries[url]['info'])
+
+    def hit(self, url):
+        '''Record a 304 response and return (a copy of) the cached info.'''
+        with self.lock:
+            entry = self.entries[url]
+            entry['fetched'] = time.time()
+            self.hits += 1
+            self.bytes_saved += entry['size']
+            return copy.deepcopy(entry['info'])
+
+    def store(self, url, response, info):
+        '''Record the info parsed from a successful response.'''
+        entry = {'etag' : response.headers.get('ETag'),
+                 'last_modified' : response.headers.get('Last-Modified'),
+                 'size' : int(response.headers.get('Content-Length', 0)),
+                 'fetched' : time.time(),
+                 'info' : copy.deepcopy(info)}
+        with self.lock:
+            self.entries[url] = entry
+
+    def save(self):
+        '''Save all entries (atomically).'''
+        save_pickle(self.path, {'version' : self.VERSION,
+                                'entries' : self.entries})
 
-    return yaml.load(content.decode('utf-8'))
+    def report(self):
+        '''Return a one-line summary of cache performance.'''
+        rate = (100.0 * self.hits / self.requests) if self.requests else 0.0
+        result = '{0}: {1} of {2} not modified ({3:.0f}%), {4} bytes saved'.format(
+            self.path, self.hits, self.requests, rate, self.bytes_saved)
+        if self.reused:
+            result += ', {0} reused without asking'.format(self.reused)
+        return result
 
 #----------------------------------------
 
-class ContentEncodedRSS2(RSS2):
-    '''Represent an RSS2 feed with content-encoded items.'''
+def extract_marked(text, name):
+    '''
+    Return the text between the first "<!-- start NAME -->" comment
+    and the last "<!-- end NAME -->" comment, or None if there isn't
+    such a pair.  This gives exactly what the P_BLOG_CONTENT and
+    P_BLOG_EXCERPT patterns do (leading whitespace and one trailing
+    whitespace character removed) but finds the markers with
+    str.find/rfind instead of letting a greedy DOTALL group run to the
+    end of the document and backtrack.  As in the patterns, the words
+    in the marker may be separated by any amount of whitespace.
+    '''
 
-    def __init__(self, **kwargs):
-        RSS2.__init__(self, **kwargs)
-        self.rss_attrs['xmlns:content']='http://purl.org/rss/1.0/modules/content/'
-        self.rss_attrs['xmlns:dc']='http://purl.org/dc/elements/1.1/'
+    start_words, end_words = ['start', name], ['end', name]
+    start = _find_marker(text, start_words, 0)
+    while start is not None:
+        after = start[1]
+        end = _rfind_marker(text, end_words, len(text), after)
+        while end is not None:
+            body = text[after:end[0]]
+            lead = min(len(body) - len(body.lstrip()), len(body) - 2)
+            if (lead >= 1) and body[-1].isspace():
+                return body[lead:-1]
+            end = _rfind_marker(text, end_words, end[0], after)
+        start = _find_marker(text, start_words, after)
+    return None
+
+
+def _marker_at(text, i, words):
+    '''
+    If a comment consisting of words starts at i, return the index just
+    past its end, otherwise None.
+    '''
+    close = text.find('-->', i + 4)
+    if close < 0:
+        return None
+    body = text[i+4:close]
+    if body and body[0].isspace() and body[-1].isspace() and (body.split() == words):
+        return close + 3
+    return None
+
+
+def _find_marker(text, words, pos):
+    '''Return (start, end) of the first marker comment at or after pos.'''
+    i = text.find('<!--', pos)
+    while i >= 0:
+        j = _marker_at(text, i, words)
+        if j is not None:
+            return (i, j)
+        i = text.find('<!--', i + 4)
+    return None
+
+
+def _rfind_marker(text, words, limit, after):
+    '''Return (start, end) of the last marker comment starting in [after, limit).'''
+    i = text.rfind('<!--', after, limit)
+    while i >= 0:
+        j = _marker_at(text, i, words)
+        if j is not None:
+            return (i, j)
+        i = text.rfind('<!--', after, i)
+    return None
+
+
+def extract_blog_parts(path):
+    '''
+    Read a blog post (source or compiled) and return its content and
+    excerpt, either of which is None if its markers are missing.  The
+    excerpt is looked for inside the content if there is any.
+    '''
+    with open(path, 'r', encoding='utf-8') as reader:
+        text = reader.read()
+    content = extract_marked(text, 'content')
+    excerpt = extract_marked(content if content is not None else text, 'excerpt')
+    return content, excerpt
+
+
+class ExtractCache(object):
+    '''
+    On-disk memo of extract_blog_parts keyed by a digest of each file's
+    bytes, so that an entry survives Jekyll rewriting an unchanged post
+    and is shared by every output directory (and by feeds and index
+    pages).  Only the content and the excerpt's position in it are kept.
+    Entries are dropped when saved if their file has gone or now has
+    different bytes.  Safe to use from several threads.
+    '''
+
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        saved = load_pickle(path, self.VERSION)
+        self.entries = saved['entries'] if saved else {}
+        self.seen = {}
+        self.changed = False
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename):
+        '''Return (content, excerpt) for filename.'''
+        with open(filename, 'rb') as reader:
+            data = reader.read()
+        digest = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            self.seen[filename] = digest
+            entry = self.entries.get(digest)
+            if entry is not None:
+                self.hits += 1
+                if (entry[0] != filename) and not os.path.isfile(entry[0]):
+                    self.entries[digest] = (filename,) + entry[1:]
+                    self.changed = True
+                return _excerpt_parts(entry[1], entry[2])
+        text = data.decode('utf-8')
+        content = extract_marked(text, 'content')
+        excerpt = extract_marked(content if content is not None else text, 'excerpt')
+        if (content is not None) and (excerpt is not None):
+            start = content.find(excerpt)
+            excerpt = (start, start + len(excerpt))
+        with self.lock:
+            self.misses += 1
+            self.entries[digest] = (filename, content, excerpt)
+            self.changed = True
+        return _excerpt_parts(content, excerpt)
+
+    def save(self):
+        '''
+        Save entries (atomically) if anything has been added, dropping
+        those whose file is missing or was read with different bytes.
+        '''
+        with self.lock:
+            entries = {d : e for (d, e) in self.entries.items()
+                       if self.seen.get(e[0], d) == d and os.path.isfile(e[0])}
+            if self.changed or (len(entries) != len(self.entries)):
+                save_pickle(self.path, {'version' : self.VERSION,
+                                        'entries' : entries})
+            self.entries = entries
+            self.changed = False
+
+    def report(self):
+        '''Return a one-line summary of cache performance.'''
+        return 'extract cache: {0} hits, {1} misses'.format(self.hits, self.misses)
+
+
+def _excerpt_parts(content, excerpt):
+    '''Turn a stored (content, excerpt or its span) back into (content, excerpt).'''
+    if isinstance(excerpt, tuple):
+        excerpt = content[excerpt[0]:excerpt[1]]
+    return content, excerpt
+
+#----------------------------------------
+
+def as_date(value):
+    '''
+    Convert a build date given as a date, a datetime, or a 'YYYY-MM-DD'
+    string (e.g., from the command line) to a date.
+    '''
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value.strip(), '%Y-%m-%d').date()
+
+
+class WorkshopIndex(object):
+    '''
+    Workshops sorted by start date, so that selections by date are
+    done with bisect (O(log n) plus the size of the result) rather than
+    by scanning every workshop.  Results are always in order of start
+    date, soonest first.  Workshops that start on the same day are kept
+    in the reverse of their original order, which matches the order
+    the site has always used for the (newest-first) list from AMY.
+    '''
+
+    def __init__(self, workshops):
+        self.workshops = sorted(reversed(workshops), key=lambda w: w['start'])
+        self.starts = [w['start'] for w in self.workshops]
+
+    def window(self, first=None, last=None):
+        '''Workshops starting between first and last (inclusive; None means unbounded).'''
+        lo = 0 if first is None else bisect.bisect_left(self.starts, first)
+        hi = len(self.starts) if last is None else bisect.bisect_right(self.starts, last)
+        return self.workshops[lo:hi]
+
+    def upcoming(self, today):
+        '''Workshops starting on or after today.'''
+        return self.window(first=today)
+
+    def past(self, today, days):
+        '''Workshops that started in the 'days' days before today.'''
+        return self.window(first=today - datetime.timedelta(days),
+                           last=today - datetime.timedelta(1))
+
+#----------------------------------------
+
+def get_coords(record):
+    '''
+    Return (latitude, longitude) of a workshop or airport as floats, or
+    None if it doesn't have a usable location.
+    '''
+    try:
+        lat, lon = float(record['latitude']), float(record['longitude'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lon <= 180.0):
+        return None
+    return lat, lon
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    '''Great-circle distance (km) between two points given in degrees.'''
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + \
+        math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GeoIndex(object):
+    '''
+    Grid index of located items (e.g., instructors' airports) for
+    "everything within R km" and "nearest N" queries.  Items are bucketed
+    into cells of GEO_CELL_DEGREES on a side; a query only computes
+    haversine distances for items in the cells that the search circle
+    can reach, so building is O(n) and a query's cost depends on how
+    many items are nearby rather than on n.  Results are lists of
+    (distance in km, item), nearest first; items at the same distance
+    stay in the order they were given.
+    '''
+
+    def __init__(self, items, cell=GEO_CELL_DEGREES):
+        self.cell = cell
+        self.columns = int(math.ceil(360.0 / cell))
+        self.points = []
+        self.cells = {}
+        for item in items:
+            coords = get_coords(item)
+            if coords is None:
+                continue
+            lat, lon = coords
+            phi = math.radians(lat)
+            self.points.append((phi, math.radians(lon), math.cos(phi), item))
+            key = (self._row(lat), self._column(lon))
+            self.cells.setdefault(key, []).append(len(self.points) - 1)
+
+    def __len__(self):
+        return len(self.points)
+
+    def within(self, lat, lon, radius):
+        '''Items no more than radius km from (lat, lon).'''
+        found = []
+        phi, lam = math.radians(lat), math.radians(lon)
+        cos_phi = math.cos(phi)
+        # Compare haversine terms rather than distances to skip asin.
+        limit = math.sin(min(radius / EARTH_RADIUS_KM, math.pi) / 2) ** 2
+        points = self.points
+        for i in self._candidates(lat, lon, radius):
+            (p_phi, p_lam, p_cos, item) = points[i]
+            a = math.sin((p_phi - phi) / 2) ** 2 + \
+                cos_phi * p_cos * math.sin((p_lam - lam) / 2) ** 2
+            if a <= limit:
+                found.append((a, i))
+        found.sort()
+        return [(2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a))), points[i][3])
+                for (a, i) in found]
+
+    def nearest(self, lat, lon, count):
+        '''The count items nearest to (lat, lon).'''
+        radius = self.cell * math.pi * EARTH_RADIUS_KM / 180.0
+        while True:
+            found = self.within(lat, lon, radius)
+            if (len(found) >= count) or (radius >= math.pi * EARTH_RADIUS_KM):
+                return found[:count]
+            radius *= 2
+
+    def _row(self, lat):
+        return int(math.floor(lat / self.cell))
+
+    def _column(self, lon):
+        return int(math.floor((lon + 180.0) / self.cell)) % self.columns
+
+    def _candidates(self, lat, lon, radius):
+        '''Indices of items in cells that a circle of radius km may touch.'''
+        angle = radius / EARTH_RADIUS_KM
+        if angle >= math.pi:
+            return range(len(self.points))
+        dlat = math.degrees(angle)
+        rows = range(self._row(max(-90.0, lat - dlat)), self._row(min(90.0, lat + dlat)) + 1)
+        # Longitude span of the circle, unless it includes a pole.
+        cos_lat = math.cos(math.radians(lat))
+        if (abs(lat) + dlat >= 90.0) or (math.sin(angle) >= cos_lat):
+            columns = range(self.columns)
+        else:
+            dlon = math.degrees(math.asin(math.sin(angle) / cos_lat))
+            first = int(math.floor((lon - dlon + 180.0) / self.cell))
+            last = int(math.floor((lon + dlon + 180.0) / self.cell))
+            if last - first + 1 >= self.columns:
+                columns = range(self.columns)
+            else:
+                columns = [c % self.columns for c in range(first, last + 1)]
+        result = []
+        for r in rows:
+            for c in columns:
+                result.extend(self.cells.get((r, c), ()))
+        result.sort()
+        return result
 
 #----------------------------------------
 
-class ContentEncodedRSSItem(RSSItem):
-    '''Represent a single item in an RSS2 feed with content encoding.'''
-
-    def __init__(self, **kwargs):
-        self.dc = 'http://purl.org/dc/elements/1.1/'
-        self.content = kwargs.get('content', None)
-        if 'content' in kwargs:
-            del kwargs['content']
-        self.creator = kwargs.get('creator', None)
-        if 'creator' in kwargs:
-            del kwargs['creator']
-        RSSItem.__init__(self, **kwargs)
-
-    def publish_extensions(self, handler):
-        if self.creator:
-          handler.startElement('dc:creator', {})
-          handler.characters(self.creator)
-          handler.endElement('dc:creator')
-        if self.content:
-            if hasattr(handler, '_out'):
-                writer = handler._out.write
-            elif hasattr(handler, '_write'):
-                writer = handler._write
+def cluster_points(points, max_zoom=MAP_MAX_ZOOM, grid=MAP_GRID_PIXELS, listed=MAP_CLUSTER_LIST):
+    '''
+    Cluster located records for display at zoom levels 0 to max_zoom of
+    a Web Mercator map (256 pixel tiles) by bucketing them into squares
+    of 'grid' pixels.  'points' is a list of (latitude, longitude,
+    record).  Points are projected and bucketed once at max_zoom; each
+    lower level's squares are 2x2 blocks of the level above, so they
+    are built by merging.  Returns a list indexed by zoom level of lists
+    of clusters, each [latitude, longitude, count] or [latitude,
+    longitude, count, records] (the latter for clusters of no more than
+    'listed' records, which are kept in their original order).
+    Clusters are placed at the mean position of their members and
+    ordered by square, so the result only depends on the points.
+    '''
+
+    scale = 256.0 * (2 ** max_zoom) / grid
+    level = {}
+    for (i, (lat, lon, record)) in enumerate(points):
+        lat = max(-MERCATOR_MAX_LAT, min(MERCATOR_MAX_LAT, lat))
+        phi = math.radians(lat)
+        x = (lon + 180.0) / 360.0
+        y = (1.0 - math.log(math.tan(phi) + 1.0 / math.cos(phi)) / math.pi) / 2.0
+        key = (int(min(y, 1.0 - 1e-12) * scale), int(min(x, 1.0 - 1e-12) * scale))
+        if key in level:
+            cell = level[key]
+            cell[0] += lat
+            cell[1] += lon
+            cell[2] += 1
+            if cell[3] is not None:
+                cell[3] = cell[3] + [i] if cell[2] <= listed else None
+        else:
+            level[key] = [lat, lon, 1, [i] if listed >= 1 else None, None]
+
+    # Each cell is [sum of latitudes, sum of longitudes, count, member
+    # indices (or None if too many), cluster (if already formatted)].
+    # A square with only one non-empty child keeps the child's cluster.
+    result = []
+    for zoom in range(max_zoom, -1, -1):
+        clusters = []
+        for key in sorted(level.keys()):
+            cell = level[key]
+            if cell[4] is None:
+                (sum_lat, sum_lon, count, members) = cell[:4]
+                cell[4] = [round(sum_lat / count, 5), round(sum_lon / count, 5), count]
+                if members is not None:
+                    cell[4].append([points[i][2] for i in members])
+            clusters.append(cell[4])
+        result.append(clusters)
+        parent = {}
+        for (key, child) in level.items():
+            up = (key[0] >> 1, key[1] >> 1)
+            if up in parent:
+                cell = parent[up]
+                cell[0] += child[0]
+                cell[1] += child[1]
+                cell[2] += child[2]
+                if (cell[3] is None) or (child[3] is None) or (cell[2] > listed):
+                    cell[3] = None
+                else:
+                    cell[3] = sorted(cell[3] + child[3])
+                cell[4] = None
+            else:
+                parent[up] = child
+        level = parent
+    result.reverse()
+    return result
+
+#----------------------------------------
+
+def slugify(name):
+    '''Turn a name (category, author, instructor, ...) into an ASCII file name.'''
+    name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    return '-'.join(re.findall(r'[a-z0-9]+', name.lower()))
+
+#----------------------------------------
+
+def yaml_load(stream):
+    '''Load YAML from a string or stream using the fastest safe loader.'''
+
+    return yaml.load(stream, Loader=YamlLoader)
+
+
+def yaml_dump(data, stream=None, **kwargs):
+    '''
+    Dump YAML to a (text) stream using the fastest safe dumper, or
+    return it as a string if no stream is given.
+    '''
+
+    kwargs.setdefault('allow_unicode', True)
+    return yaml.dump(data, stream, Dumper=YamlDumper, **kwargs)
+
+#----------------------------------------
+
+class FeedWriter(object):
+    '''
+    Write an RSS 2.0 or Atom feed to a text stream one item at a time,
+    so that a feed of N posts never holds more than one post's content
+    in memory.  The channel header is written on construction and the
+    closing tags by close(); in between, call item() once per entry.
+    Items are dictionaries with some or all of the keys:
+
+        title, link, description, content, creator, date,
+        guid, permalink, categories
+
+    'date' is a datetime (naive values are taken to be UTC),
+    'categories' a list of (term, domain) pairs, and 'permalink' says
+    whether 'guid' (default: 'link') is the item's URL.
+
+    'links' is a list of (rel, href) pairs for the channel, such as the
+    'current', 'prev-archive' and 'next-archive' links of an RFC 5005
+    paged feed; 'archive' marks the document as an archive page.
+    '''
+
+    FORMATS = ('rss', 'atom')
+    GENERATOR = 'Software Carpentry site tools'
+
+    def __init__(self, stream, format, title, link, description, updated=None, ident=None,
+                 links=None, archive=False):
+        assert format in self.FORMATS, \
+               'Unknown feed format "{0}"'.format(format)
+        self.stream = stream
+        self.format = format
+        updated = updated or datetime.datetime.utcnow()
+        self._header(title, link, description, updated, ident or link, links or [], archive)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def item(self, item):
+        '''Write a single item.'''
+        if self.format == 'rss':
+            self._rss_item(item)
+        else:
+            self._atom_entry(item)
+
+    def close(self):
+        '''Write the closing tags.'''
+        if self.format == 'rss':
+            self.stream.write('</channel></rss>\n')
+        else:
+            self.stream.write('</feed>\n')
+
+    def _header(self, title, link, description, updated, ident, links, archive):
+        w = self.stream.write
+        w('<?xml version="1.0" encoding="utf-8"?>\n')
+        history = ' xmlns:fh="{0}"'.format(FEED_HISTORY_NS) if archive else ''
+        if self.format == 'rss':
+            w('<rss version="2.0" '
+              'xmlns:content="http://purl.org/rss/1.0/modules/content/" '
+              'xmlns:dc="http://purl.org/dc/elements/1.1/"')
+            if links:
+                w(' xmlns:atom="{0}"'.format(ATOM_NS))
+            w(history + '>')
+            w('<channel>')
+            _feed_element(w, 'title', title)
+            _feed_element(w, 'link', link)
+            _feed_element(w, 'description', description)
+            _feed_element(w, 'lastBuildDate', _rss_date(updated))
+            _feed_element(w, 'generator', self.GENERATOR)
+            _feed_element(w, 'docs', 'http://www.rssboard.org/rss-specification')
+            for (rel, href) in links:
+                w('<atom:link rel={0} href={1}/>'.format(quoteattr(rel), quoteattr(href)))
+            if archive:
+                w('<fh:archive/>')
+        else:
+            w('<feed xmlns="{0}"{1}>'.format(ATOM_NS, history))
+            _feed_element(w, 'title', title)
+            _feed_element(w, 'subtitle', description)
+            w('<link href={0}/>'.format(quoteattr(link)))
+            _feed_element(w, 'id', ident)
+            _feed_element(w, 'updated', _atom_date(updated))
+            _feed_element(w, 'generator', self.GENERATOR)
+            for (rel, href) in links:
+                w('<link rel={0} href={1}/>'.format(quoteattr(rel), quoteattr(href)))
+            if archive:
+                w('<fh:archive/>')
+
+    def _rss_item(self, item):
+        w = self.stream.write
+        w('<item>')
+        _feed_element(w, 'title', item.get('title'))
+        _feed_element(w, 'link', item.get('link'))
+        _feed_element(w, 'description', item.get('description'))
+        for (term, domain) in item.get('categories', ()):
+            if domain:
+                w('<category domain={0}>'.format(quoteattr(domain)))
             else:
-                assert False, \
-                       'XML handler does not have _out or _write'
-            writer('<%(e)s><![CDATA[%(c)s]]></%(e)s>' %
-                   { 'e':'content:encoded', 'c':self.content})
+                w('<category>')
+            w(escape(str(term)))
+            w('</category>')
+        guid = item.get('guid', item.get('link'))
+        if guid:
+            permalink = 'true' if item.get('permalink', True) else 'false'
+            w('<guid isPermaLink="{0}">{1}</guid>'.format(permalink, escape(guid)))
+        if item.get('date'):
+            _feed_element(w, 'pubDate', _rss_date(item['date']))
+        _feed_element(w, 'dc:creator', item.get('creator'))
+        if item.get('content'):
+            w('<content:encoded>')
+            _feed_cdata(w, item['content'])
+            w('</content:encoded>')
+        w('</item>')
+
+    def _atom_entry(self, item):
+        w = self.stream.write
+        w('<entry>')
+        _feed_element(w, 'title', item.get('title'))
+        if item.get('link'):
+            w('<link href={0}/>'.format(quoteattr(item['link'])))
+        _feed_element(w, 'id', item.get('guid', item.get('link')))
+        if item.get('date'):
+            _feed_element(w, 'updated', _atom_date(item['date']))
+        if item.get('creator'):
+            w('<author>')
+            _feed_element(w, 'name', item['creator'])
+            w('</author>')
+        for (term, domain) in item.get('categories', ()):
+            attrs = 'term={0}'.format(quoteattr(str(term)))
+            if domain:
+                attrs += ' scheme={0}'.format(quoteattr(domain))
+            w('<category {0}/>'.format(attrs))
+        if item.get('description'):
+            w('<summary type="html">')
+            w(escape(item['description']))
+            w('</summary>')
+        if item.get('content'):
+            w('<content type="html">')
+            _feed_cdata(w, item['content'])
+            w('</content>')
+        w('</entry>')
+
+#----------------------------------------
+
+def write_feed(items, *writers):
+    '''
+    Pass each item from an iterable (typically a generator that reads
+    each post as it is needed) to every feed writer as it is produced,
+    then close the writers.  An item's 'content' may be a callable, in
+    which case it is called once, just before the item is written, and
+    the result is shared by all the writers.
+    '''
+    for item in items:
+        if callable(item.get('content')):
+            item = dict(item, content=item['content']())
+        for writer in writers:
+            writer.item(item)
+    for writer in writers:
+        writer.close()
+
+#----------------------------------------
+
+def _feed_element(write, name, text):
+    '''Write a simple text element if there is any text.'''
+    if text is None:
+        return
+    write('<{0}>{1}</{0}>'.format(name, escape(str(text))))
+
+
+def _feed_cdata(write, text):
+    '''Write text as CDATA, splitting any embedded end markers.'''
+    write('<![CDATA[')
+    write(text.replace(']]>', ']]]]><![CDATA[>'))
+    write(']]>')
+
+
+def _feed_utc(when):
+    '''Convert a date or datetime to a naive datetime in UTC.'''
+    if not isinstance(when, datetime.datetime):
+        when = datetime.datetime.fromordinal(when.toordinal())
+    if when.tzinfo is not None:
+        when = when.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return when
+
+
+def _rss_date(when):
+    '''Format a date or datetime as RFC 822 (always in GMT).'''
+    when = _feed_utc(when)
+    return email.utils.formatdate(calendar.timegm(when.timetuple()), usegmt=True)
+
+
+def _atom_date(when):
+    '''Format a date or datetime as RFC 3339 in UTC.'''
+    when = _feed_utc(when)
+    return when.strftime('%Y-%m-%dT%H:%M:%SZ')
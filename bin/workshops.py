@@ -1,19 +1,31 @@
 """
 Download information about workshops from GitHub.
-Usage: workshops.py [-i input_file] [-o output_file] [-t]
+Usage: workshops.py [-i input_file] [-o output_file] [-t] [-j jobs]
 -i: optional input filename (default sys.stdin)
 -o: optional output filename (default sys.stdout)
 -t: tolerate errors (default False)
+-j: number of concurrent fetches (default 8)
+--no-cache: don't use or update the conditional-request cache
+--incremental: only fetch URLs that aren't already in the output file
+  (or whose cached copy is older than --ttl days), then rewrite it
+--base: with --incremental, entries to put at the start of the output
+  (e.g., archived workshops)
+--raw-base: fetch index.html files from this base URL instead of GitHub
 If the -t flag is used, output is written for all correct entries.
 If it is not, output is only written if *all* entries are correct.
 """
 
 import sys
+import os
 import re
+import time
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from optparse import OptionParser
-import yaml
+from urllib.parse import urlparse
 import requests
+from util import FETCH_CACHE, FetchCache, read_front_matter, yaml_load, yaml_dump
 
 GITHUB_IO_TEMPLATE = 'http://{0}.github.io/{1}/'
 
@@ -25,6 +37,23 @@ LATLNG_RE = re.compile(r'\s*[+-]?\d+(\.\d*)?,\s*[+-]?\d+(\.\d*)?\s*')
 
 ARCHIVE_WINDOW = 3
 
+# Number of workshop repositories fetched at once.
+DEFAULT_JOBS = 8
+
+# Minimum time (in seconds) between starting requests to the same host.
+HOST_INTERVAL = 0.05
+
+# How many times to retry a failed request, and the initial delay (in
+# seconds) before retrying, which doubles after each attempt.
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 0.5
+
+# Connect and read timeouts (in seconds) for each request.
+FETCH_TIMEOUT = (10, 30)
+
+# Status codes that are worth retrying.
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
 ADJUSTMENTS = {
     # Turn hyphenated country names into ISO codes for past workshops.
     'country' : {
@@ -70,22 +99,43 @@ CLEANUP = {
     'latlng' : _cleanup_handler
 }
 
+class FetchError(Exception):
+    '''A workshop's index.html couldn't be fetched or parsed.'''
+
 def main(args):
     '''Main driver.'''
 
-    reader_filename, writer_filename, archiver_filename, tolerate, verbose = setup(args)
+    options = setup(args)
+    reader_filename, writer_filename, archiver_filename = \
+        options.input, options.output, options.archive
+
+    if options.incremental and (writer_filename == '-'):
+        fail('--incremental requires an output file')
 
     reader, writer = sys.stdin, sys.stdout
     if reader_filename != '-':
         reader = open(reader_filename, 'r')
-    if writer_filename != '-':
+    if (writer_filename != '-') and not options.incremental:
         # We append due the way that we call this script in `Makefile`.
         writer = open(writer_filename, 'a')
 
-    all_urls = yaml.load(reader)
+    all_urls = yaml_load(reader)
     reader.close()
 
-    results, faulty = process(all_urls, verbose)
+    cache = None if options.no_cache else FetchCache(FETCH_CACHE)
+    todo = all_urls
+    if options.incremental:
+        base, previous = load_previous(writer_filename, options.base, all_urls)
+        todo = select_stale(all_urls, previous, cache, options.ttl, options.raw_base)
+        if options.verbose:
+            print('{0} of {1} URLs need fetching'.format(len(todo), len(all_urls)))
+    results, faulty = process(todo, options.verbose, options.jobs, options.raw_base, cache)
+    if cache is not None:
+        cache.save()
+        print(cache.report(), file=sys.stderr)
+    if options.incremental:
+        cleanup(results)
+        results = merge_results(all_urls, todo, results, previous)
     if faulty:
         print('Errors in these URLs:', file=sys.stderr)
         for f in faulty:
@@ -97,9 +147,17 @@ def main(args):
         reader.close()
         archiver.close()
 
-    if (not faulty) or tolerate:
+    if options.incremental:
+        if (not faulty) or options.tolerate:
+            temp = writer_filename + '.tmp'
+            with open(temp, 'w', encoding='utf-8') as writer:
+                yaml_dump(base + results, writer)
+            os.replace(temp, writer_filename)
+        return
+
+    if (not faulty) or options.tolerate:
         cleanup(results)
-        yaml.dump(results, writer, encoding='utf-8', allow_unicode=True)
+        yaml_dump(results, writer)
 
     writer.close()
 
@@ -113,46 +171,199 @@ def setup(args):
                       default=False, action='store_true')
     parser.add_option('-v', '--verbose', dest='verbose', help='report progress',
                       default=False, action='store_true')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=DEFAULT_JOBS,
+                      help='number of concurrent fetches')
+    parser.add_option('--no-cache', dest='no_cache', help='do not use cached headers',
+                      default=False, action='store_true')
+    parser.add_option('--incremental', dest='incremental', help='only fetch new or stale URLs',
+                      default=False, action='store_true')
+    parser.add_option('--base', dest='base', help='entries to start output with (--incremental only)',
+                      default=None)
+    parser.add_option('--ttl', dest='ttl', type='float', default=None,
+                      help='re-fetch entries cached more than this many days ago')
+    parser.add_option('--raw-base', dest='raw_base', default=None,
+                      help='base URL to fetch index.html files from (for testing)')
     options, args = parser.parse_args(args)
 
-    return options.input, options.output, options.archive, options.tolerate, options.verbose
+    return options
 
-def process(all_urls, verbose):
+def process(all_urls, verbose, jobs=1, raw_base=None, cache=None):
     '''
     Process URLs, returning list of valid info structures and list
-    of URLs found faulty.
+    of URLs found faulty.  Up to 'jobs' URLs are fetched concurrently,
+    but results are kept in the same order as all_urls.  If any fetch
+    fails, the errors are reported and the program exits once all of
+    the fetches have finished.
     '''
+    session = make_session(jobs)
+    limiter = RateLimiter(HOST_INTERVAL)
     results = []
     faulty = []
-    for url in all_urls:
-        info = fetch(url)
-        adjust(info, url)
-        info['user'], info['slug'] = extract_info_from_url(url)
-        info['url'] = GITHUB_IO_TEMPLATE.format(info['user'], info['slug'])
-        if check_info(url, info):
-            if verbose:
-                print('+ {0}'.format(url))
-            results.append(info)
-        else:
-            if verbose:
-                print('!'.format(url))
-            faulty.append(url)
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = [pool.submit(fetch_page, get_raw_url(u, raw_base), session, limiter, cache)
+                   for u in all_urls]
+        for (url, future) in zip(all_urls, futures):
+            try:
+                info = future.result()
+            except FetchError as e:
+                errors.append(str(e))
+                continue
+            check_result(url, info, verbose, results, faulty)
+    if errors:
+        if cache is not None:
+            cache.save()
+        fail('{0}', '\n'.join(errors))
     return results, faulty
 
-def fetch(url):
-    '''Fetch information from a single online repository.'''
-    url = url.replace('github.com', 'raw.github.com') + '/gh-pages/index.html'
-    response = requests.get(url)
-    if response.status_code != 200:
-        fail('Request for {0} returned status code {1}', url, response.status_code)
-    pieces = response.text.split('---')
-    if len(pieces) < 2:
-        fail('Malformed YAML header in {0}', url)
+def load_previous(output_filename, base_filename, all_urls):
+    '''
+    Load the previous output of an incremental run, returning the
+    entries that should start the new output (those in the base file
+    if given, otherwise previous entries that don't correspond to any
+    URL in all_urls) and a lookup table of previous entries keyed by
+    (user, slug).
+    '''
+    entries = []
+    if os.path.isfile(output_filename):
+        with open(output_filename, 'r', encoding='utf-8') as reader:
+            entries = yaml_load(reader) or []
+    previous = {(e['user'], e['slug']) : e for e in entries
+                if ('user' in e) and ('slug' in e)}
+
+    if base_filename:
+        with open(base_filename, 'r', encoding='utf-8') as reader:
+            base = yaml_load(reader) or []
+    else:
+        wanted = {extract_info_from_url(url) for url in all_urls}
+        base = [e for e in entries if (e.get('user'), e.get('slug')) not in wanted]
+    return base, previous
+
+def select_stale(all_urls, previous, cache, ttl, raw_base=None):
+    '''
+    Select URLs that have no previous entry or (if ttl is given) whose
+    cached copy is more than ttl days old or of unknown age.
+    '''
+    result = []
+    for url in all_urls:
+        if extract_info_from_url(url) not in previous:
+            result.append(url)
+        elif ttl is not None:
+            age = cache.age(get_raw_url(url, raw_base)) if cache else None
+            if (age is None) or (age > ttl * 24 * 60 * 60):
+                result.append(url)
+    return result
+
+def merge_results(all_urls, fetched_urls, results, previous):
+    '''
+    Combine freshly-fetched results with previous entries, in the
+    order of all_urls.  URLs that were fetched but failed are left out.
+    '''
+    fetched_urls = set(fetched_urls)
+    fresh = {(r['user'], r['slug']) : r for r in results}
+    merged = []
+    for url in all_urls:
+        key = extract_info_from_url(url)
+        if key in fresh:
+            merged.append(fresh[key])
+        elif (url not in fetched_urls) and (key in previous):
+            merged.append(previous[key])
+    return merged
+
+def check_result(url, info, verbose, results, faulty):
+    '''Adjust and check the info fetched for url, recording it as valid or faulty.'''
+    adjust(info, url)
+    info['user'], info['slug'] = extract_info_from_url(url)
+    info['url'] = GITHUB_IO_TEMPLATE.format(info['user'], info['slug'])
+    if check_info(url, info):
+        if verbose:
+            print('+ {0}'.format(url))
+        results.append(info)
+    else:
+        if verbose:
+            print('!'.format(url))
+        faulty.append(url)
+
+def make_session(jobs=1):
+    '''Create an HTTP session whose connection pool can serve 'jobs' threads.'''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max(1, jobs),
+                                            pool_maxsize=max(1, jobs))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+class RateLimiter(object):
+    '''Space out the start of requests to each host by at least 'interval' seconds.'''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_start = {}
+
+    def wait(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_start.get(host, now))
+            self.next_start[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+def get_raw_url(url, raw_base=None):
+    '''Get the URL of the raw index.html file for a workshop repository.'''
+    if raw_base:
+        user, slug = extract_info_from_url(url)
+        return '{0}/{1}/{2}/gh-pages/index.html'.format(raw_base.rstrip('/'), user, slug)
+    return url.replace('github.com', 'raw.github.com') + '/gh-pages/index.html'
+
+def get_with_retries(url, session, limiter, headers=None):
+    '''
+    Get a URL, retrying with exponential backoff on failure.  The body
+    is read in full (index.html files are small) so that the connection
+    goes back to the session's pool and can be re-used.
+    '''
+    delay = FETCH_BACKOFF
+    for attempt in range(FETCH_RETRIES + 1):
+        if limiter:
+            limiter.wait(url)
+        try:
+            response = session.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+            if (response.status_code not in RETRY_STATUS) or (attempt == FETCH_RETRIES):
+                return response
+        except requests.exceptions.RequestException as e:
+            if attempt == FETCH_RETRIES:
+                raise FetchError('Request for {0} failed: {1}'.format(url, str(e)))
+        time.sleep(delay)
+        delay *= 2
+
+def fetch(url, session=None, limiter=None, raw_base=None, cache=None):
+    '''
+    Fetch information from a single online repository, re-using the
+    cached copy if the cache is given and the server says it's unchanged.
+    Raises FetchError if it can't be fetched or parsed.
+    '''
+    return fetch_page(get_raw_url(url, raw_base), session, limiter, cache)
+
+def fetch_page(url, session=None, limiter=None, cache=None):
+    '''Fetch and parse the header of a raw index.html file (see fetch).'''
+    headers = cache.conditional_headers(url) if cache else None
+    with get_with_retries(url, session or requests.Session(), limiter, headers) as response:
+        if (response.status_code == 304) and cache:
+            return cache.hit(url)
+        if response.status_code != 200:
+            raise FetchError('Request for {0} returned status code {1}'.format(url, response.status_code))
+        if response.encoding is None:
+            response.encoding = 'utf-8'
+        header = read_front_matter(response.text.splitlines())
+    if header is None:
+        raise FetchError('Malformed YAML header in {0}'.format(url))
     try:
-        info = yaml.load(pieces[1])
+        info = yaml_load(header)
     except Exception as e:
-        fail('Unable to parse YAML for {0}: {1}'.format(url, str(e)))
-        raise e
+        raise FetchError('Unable to parse YAML for {0}: {1}'.format(url, str(e)))
+    if cache:
+        cache.store(url, response, info)
     return info
 
 def adjust(info, url):
@@ -215,11 +426,9 @@ def archive(all_urls, results, reader, archiver):
         else:
             upcoming_urls.append(all_urls[i])
 
-    yaml.dump(upcoming_urls, reader, default_flow_style=False,
-              encoding='utf-8', allow_unicode=True)
+    yaml_dump(upcoming_urls, reader, default_flow_style=False)
     if archive_info:
-        yaml.dump(archive_info, archiver, encoding='utf-8',
-                allow_unicode=True)
+        yaml_dump(archive_info, archiver)
 
 def should_be_archived(record):
     if 'enddate' in record:
@@ -5,140 +5,126 @@ var SWC = SWC || {};
 SWC.maps = (function() {
   var maps = {};
 
+  // Markers are pre-clustered by bin/preprocess.py: maps/NAME-ZOOM.json
+  // holds a list of [latitude, longitude, count, records] for each zoom
+  // level, where records (each [title, url, note, note_url]) are only
+  // present for small clusters.  The page gives the (relative) site root
+  // in the data-root attribute of the script tag that loads this file.
+  var script = document.querySelector('script[data-root]'),
+      root = (script ? script.getAttribute('data-root') : '.') + '/',
+      max_zoom = {{site.map_max_zoom}},
+      loaded = {};
+
   function toggleScrollwheel(map, enabled) {
       if(map) map.setOptions({ scrollwheel: enabled });
   }
 
-  function add_cluster_event_listeners(clusterer, map, info_window) {
-      google.maps.event.addListener(clusterer, 'clusterclick', function(cluster) {
-        info_window.setPosition(cluster.getCenter());
-        var info_string = "<div class=\"info-window\">";
-        var i=0;
-        var markers = cluster.getMarkers();
-        for (; i < markers.length; i++ )
+  function load_clusters(name, zoom, callback) {
+      var url = root + 'maps/' + name + '-' + zoom + '.json';
+      if (url in loaded) {
+        callback(loaded[url]);
+        return;
+      }
+      var request = new XMLHttpRequest();
+      request.onreadystatechange = function() {
+        if (request.readyState === 4 && request.status === 200) {
+          loaded[url] = JSON.parse(request.responseText);
+          callback(loaded[url]);
+        }
+      };
+      request.open('GET', url, true);
+      request.send();
+  }
+
+  function link(text, url) {
+      if (!url) return text;
+      if (!/^[a-z]+:\/\//.test(url)) url = root + url;
+      return "<a href=\"" + url + "\">" + text + "</a>";
+  }
+
+  function cluster_info(cluster, noun) {
+      var info_string = "<div class=\"info-window\">";
+      if (cluster.length > 3) {
+        var i = 0, records = cluster[3];
+        for (; i < records.length; i++ )
         {
-          info_string += markers[i].getTitle();
+          info_string += "<h5>" + link(records[i][0], records[i][1]) + "</h5>";
+          if (records[i][2]) info_string += "<h6>" + link(records[i][2], records[i][3]) + "</h6>";
         }
-        info_string += "</div>";
-        // reset content so that scroll bar in new content will always be at
-        // top of content
-        info_window.setContent( "<div class=\"info-window\"></div>");
-        info_window.setContent(info_string);
-        info_window.open(map);
-        // when the info window has a scroll bar, we want the mouse scroll wheel
-        //   to scroll in the info window, NOT zoom the map.  Disable map zoom.
-        toggleScrollwheel(map, false);
-      });
+      } else {
+        info_string += "<h5>" + cluster[2] + " " + noun + "</h5><p>Zoom in to see them all.</p>";
+      }
+      return info_string + "</div>";
+  }
+
+  function show_clusters(map, name, noun) {
+      var markers = [],
+          info_window = new google.maps.InfoWindow();
+
+      function redraw() {
+        var zoom = Math.max(0, Math.min(max_zoom, map.getZoom()));
+        load_clusters(name, zoom, function(clusters) {
+          var i = 0;
+          for (; i < markers.length; i++) markers[i].setMap(null);
+          markers = [];
+          for (i = 0; i < clusters.length; i++) {
+            markers.push(add_marker(clusters[i]));
+          }
+        });
+      }
+
+      function add_marker(cluster) {
+        var marker = new google.maps.Marker({
+          position: new google.maps.LatLng(cluster[0], cluster[1]),
+          map: map,
+          label: cluster[2] > 1 ? String(cluster[2]) : undefined
+        });
+        google.maps.event.addListener(marker, 'click', function() {
+          // reset content so that scroll bar in new content will always be at
+          // top of content
+          info_window.setContent( "<div class=\"info-window\"></div>");
+          info_window.setContent(cluster_info(cluster, noun));
+          info_window.open(map, marker);
+          // when the info window has a scroll bar, we want the mouse scroll wheel
+          //   to scroll in the info window, NOT zoom the map.  Disable map zoom.
+          toggleScrollwheel(map, false);
+        });
+        return marker;
+      }
+
       // zooming changes our clusters completely.  The info window is no longer
       //  accurate.  Close it.  Make people pick a new cluster or marker.
       google.maps.event.addListener(map, 'zoom_changed', function(event){
         info_window.close();
+        toggleScrollwheel(map, true);
+        redraw();
       });
       // when the info window is closed, restore mousewheel zoom on the map
       google.maps.event.addListener(info_window, 'closeclick', function(){
-      toggleScrollwheel(map, true);
+        toggleScrollwheel(map, true);
       });
-  };
-
+      redraw();
+  }
 
-  maps.upcoming = function() {
+  function make_map() {
       var mapOptions = {
         zoom: 2,
         center: new google.maps.LatLng(25,8),
         mapTypeId: google.maps.MapTypeId.ROADMAP
-      },
-      map = new google.maps.Map(document.getElementById('map_canvas'), mapOptions);
-      var markers = [];
-      // Go over all the upcoming camps and create pins in the map
-      {% for W in site.workshops %}
-        {% if W.start >= site.today and W.latitude and W.longitude %}
-          var marker = new google.maps.Marker({
-            position: new google.maps.LatLng({{W.latitude}}, {{W.longitude}}),
-            map: map,
-              title: "<h5><a href=\"{% if W.url %}{{W.url}}{% else %}{{page.root}}/{{W.path}}{% endif %}\">{{W.venue}}</a></h5>" +
-                  "<h6><a href=\"{{page.root}}/{{W.path}}\">{{W.humandate}}</a></h6>",
-            visible: false  // marker not shown directly, just clustered
-          });
-          markers.push(marker)
-        {% else %}
-          // not including {{W.path}}/{{W.venue}}/{{W.humandate}} in upcoming map
-        {% endif %}
-      {% endfor %}
-      var mcOptions = {
-        zoomOnClick: false,
-        maxZoom: null,
-        gridSize: 25,
-        minimumClusterSize: 1
-      }
-      var mc = new MarkerClusterer(map, markers, mcOptions);
-      info_window = new google.maps.InfoWindow();
-      add_cluster_event_listeners(mc, map, info_window);
+      };
+      return new google.maps.Map(document.getElementById('map_canvas'), mapOptions);
   }
 
-  maps.previous = function() {
-      var mapOptions = {
-        zoom: 2,
-        center: new google.maps.LatLng(25,8),
-        mapTypeId: google.maps.MapTypeId.ROADMAP
-      },
-      map = new google.maps.Map(document.getElementById('map_canvas'), mapOptions);
-      var markers = [];
-      // Go over all the previous camps and create pins in the map
-      {% for W in site.workshops reversed %}
-        {% if W.start < site.today and W.latitude and W.longitude %}
-          var marker = new google.maps.Marker({
-            position: new google.maps.LatLng({{W.latitude}}, {{W.longitude}}),
-            map: map,
-            title: "<h5><a href=\"{% if W.url %}{{W.url}}{% else %}{{page.root}}/{{W.path}}{% endif %}\">{{W.venue}}</a></h5>" +
-            "<h6><a href=\"{{page.root}}/{{W.path}}\">{{W.humandate}}</a></h6>",
-            visible: false  // marker not shown directly, just clustered
-          });
-          markers.push(marker); // For clustering
-        {% else %}
-          // not including {{W.path}}/{{W.venue}}/{{W.humandate}} in previous map
-        {% endif %}
-      {% endfor %}
+  maps.upcoming = function() {
+      show_clusters(make_map(), 'upcoming', 'workshops');
+  }
 
-      var mcOptions = {
-        zoomOnClick: false,
-        maxZoom: null,
-        gridSize: 25,
-        minimumClusterSize: 1
-      }
-      var mc = new MarkerClusterer(map, markers, mcOptions);
-      info_window = new google.maps.InfoWindow();
-      add_cluster_event_listeners(mc, map, info_window);
+  maps.previous = function() {
+      show_clusters(make_map(), 'previous', 'workshops');
   }
 
   maps.instructors = function() {
-      var mapOptions = {
-      zoom: 2,
-      center: new google.maps.LatLng(25,8),
-      mapTypeId: google.maps.MapTypeId.ROADMAP
-      },
-      map = new google.maps.Map(document.getElementById('map_canvas'), mapOptions);
-      var markers = [];
-      // Go over all airports to read instructor location
-      {% for airport in site.airports %}
-          {% for person in airport.instructors %}
-            var marker = new google.maps.Marker({
-              position: new google.maps.LatLng({{airport.latitude}}, {{airport.longitude}}),
-              map: map,
-              visible: false, // marker not shown directly, just clustered
-              title: "<h5><a href=\"{{site.url}}/pages/team.html#{{person.user}}\">{{person.name}}</a></h5>"
-              });
-            markers.push(marker); // For clustering
-          {% endfor %}
-      {% endfor %}
-      var mcOptions = {
-        zoomOnClick: false,
-        maxZoom: null,
-        gridSize: 25,
-        minimumClusterSize: 1
-      }
-      var mc = new MarkerClusterer(map,markers,mcOptions);
-      info_window = new google.maps.InfoWindow({}),
-      add_cluster_event_listeners(mc, map, info_window);
+      show_clusters(make_map(), 'instructors', 'instructors');
   }
 
   return maps;